@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Measures the overhead czmake itself adds to a build.
+
+Synthetic fixtures (a build.czmake file with hundreds of inheriting configurations, a CMakeCache.txt
+with tens of thousands of entries and multi-MB generated files) are created in a temporary directory
+and a stub cmake executable replaces the real one, so that only czmake's own work is timed.
+
+Usage: python benchmarks/bench_czmake.py [-o results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import join, dirname, abspath
+
+repo_root = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+from czmake import api, configure, utils, cmake_cache  # noqa: E402
+
+stub_cmake = '''#!%s
+import sys
+if '--version' in sys.argv:
+    print('cmake version 3.28.0')
+''' % sys.executable
+
+
+def make_fixtures(root, configurations, cache_entries, generated_mb):
+    project = join(root, 'project')
+    os.makedirs(project)
+    confs = {}
+    chain = 20
+    for i in range(configurations):
+        conf = {'options': {'OPTION_%d' % i: i % 2 == 0, 'PATH_%d' % (i % 50): '/opt/%d' % i},
+                'cmake_target': ['target_%d' % (i % 10)]}
+        if i % chain:
+            conf['inherits'] = 'conf%d' % (i - 1)
+        confs['conf%d' % i] = conf
+    leaves = ['conf%d' % i for i in range(chain - 1, configurations, chain)]
+    with open(join(project, 'build.czmake'), 'w') as f:
+        json.dump({'default': leaves[-1], 'configurations': confs}, f)
+
+    cache = join(root, 'CMakeCache.txt')
+    with open(cache, 'w') as f:
+        f.write('# This is the CMakeCache file.\n\n########################\n# EXTERNAL cache entries\n')
+        for i in range(cache_entries):
+            f.write('//Help string for entry %d\nENTRY_%d:%s=value_%d\n\n' % (i, i, ('BOOL', 'STRING', 'PATH')[i % 3], i))
+            if i % 7 == 0:
+                f.write('ENTRY_%d-ADVANCED:INTERNAL=1\n' % i)
+
+    generated = join(root, 'generated.h')
+    line = '#define GENERATED_SYMBOL_%08d 0x%08x\n'
+    content = ''.join(line % (i, i) for i in range(generated_mb * 1024 * 1024 // len(line % (0, 0))))
+    with open(generated, 'w') as f:
+        f.write(content)
+
+    cmake = join(root, 'cmake')
+    with open(cmake, 'w') as f:
+        f.write(stub_cmake)
+    os.chmod(cmake, 0o755)
+    return {'project': project, 'leaves': leaves, 'cache': cache, 'generated': generated,
+            'content': content, 'cmake': cmake}
+
+
+def measure(function, repeat):
+    """Returns the best wall time of ``repeat`` calls and the peak traced memory of the first one"""
+    times = []
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_bytes': peak}
+
+
+def measure_process(cmd, repeat, **kwargs):
+    """Same as measure() for an external process, the memory is the peak resident set size"""
+    times, peak = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, **kwargs)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        times.append(time.perf_counter() - start)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        peak = max(peak, rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024))
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_bytes': peak}
+
+
+def run_benchmarks(fx, repeat):
+    results = {}
+    conf_file = join(fx['project'], 'build.czmake')
+
+    def parse_cfg():
+        sys.argv = ['czconfigure', '-f', conf_file, '-E', fx['cmake'], '-c'] + fx['leaves'][-5:]
+        configure.parse_cfg()
+
+    results['parse_cfg'] = measure(parse_cfg, repeat)
+
+    def resolve_all():
+        build_file = api.BuildFile.load(conf_file)
+        for name in fx['leaves']:
+            build_file.resolve(name, cmake_exe=fx['cmake'])
+
+    results['api_resolve_all'] = measure(resolve_all, repeat)
+
+    nested = {'options': {'KEY_%d' % i: {'nested': {'value': i}} for i in range(5000)}}
+    results['update_dict'] = measure(lambda: utils.update_dict({'options': {}}, nested), repeat)
+
+    def read_cache():
+        with open(fx['cache'], 'r') as f:
+            cmake_cache.read_cache(f)
+
+    results['read_cache'] = measure(read_cache, repeat)
+
+    unchanged = fx['generated'] + '.copy'
+    shutil.copy(fx['generated'], unchanged)
+    results['write_if_different_unchanged'] = measure(
+        lambda: utils.write_if_different(unchanged, fx['content']), repeat)
+    changed = fx['generated'] + '.changed'
+    contents = [fx['content'], fx['content'][:-1] + 'X']
+
+    def write_changed():
+        contents.reverse()
+        utils.write_if_different(changed, contents[0])
+
+    results['write_if_different_changed'] = measure(write_changed, repeat)
+
+    env = dict(os.environ, CZMAKE_CMAKE=fx['cmake'], CZMAKE_HISTORY='', PYTHONPATH=repo_root)
+    results['python_startup'] = measure_process([sys.executable, '-c', 'pass'], repeat, env=env)
+    results['startup_czconfigure_list'] = measure_process(
+        [sys.executable, '-c', 'from czmake.configure import run; run()', '-f', conf_file, '--list'],
+        repeat, env=env, cwd=fx['project'])
+    results['startup_czmake_help'] = measure_process(
+        [sys.executable, '-c', 'from czmake.build import run; run()', '--help'],
+        repeat, env=env, cwd=fx['project'])
+    results['czconfigure'] = measure_process(
+        [sys.executable, '-c', 'from czmake.configure import run; run()', '-f', conf_file, '--build'],
+        repeat, env=env, cwd=fx['project'])
+    build_directory = join(fx['project'], 'build-project-%s' % fx['leaves'][-1])
+    results['czmake'] = measure_process(
+        [sys.executable, '-c', 'from czmake.build import run; run()', '-b', build_directory],
+        repeat, env=env, cwd=fx['project'])
+    return results
+
+
+def check_startup(results, budget):
+    """Returns the startup benchmarks whose time, net of the bare interpreter startup, exceeds ``budget`` seconds"""
+    over = []
+    for name, result in results.items():
+        if name.startswith('startup_'):
+            overhead = result['seconds'] - results['python_startup']['seconds']
+            if overhead > budget:
+                over.append(name)
+                print('OVER BUDGET %-31s %8.2f ms > %8.2f ms' % (name, overhead * 1e3, budget * 1e3))
+    return over
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get('results', {}).get(name, None)
+        if reference and result['seconds'] > reference['seconds'] * (1 + threshold):
+            regressions.append(name)
+            print('REGRESSION %-32s %8.2f ms -> %8.2f ms' % (name, reference['seconds'] * 1e3, result['seconds'] * 1e3))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', default='bench_results.json', help='file where the results are stored as JSON')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed repetitions of each benchmark')
+    parser.add_argument('--configurations', type=int, default=400, help='configurations in the synthetic build.czmake')
+    parser.add_argument('--cache-entries', type=int, default=50000, help='entries in the synthetic CMakeCache.txt')
+    parser.add_argument('--generated-mb', type=int, default=16, help='size of the synthetic generated file in MB')
+    parser.add_argument('--compare', metavar='BASELINE', help='fail if any benchmark is slower than in BASELINE')
+    parser.add_argument('--startup-budget', type=float, default=50, metavar='MS',
+                        help='fail if starting an entry point takes longer than MS milliseconds '
+                             'more than starting the bare Python interpreter')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerated slowdown with --compare (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='czmake-bench-')
+    try:
+        fx = make_fixtures(root, args.configurations, args.cache_entries, args.generated_mb)
+        results = run_benchmarks(fx, args.repeat)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    for name, result in results.items():
+        print('%-32s %10.2f ms %10.1f MiB' % (name, result['seconds'] * 1e3, result['peak_bytes'] / 2 ** 20))
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_root,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    with open(args.output, 'w') as f:
+        json.dump({'time': time.time(), 'revision': revision, 'python': platform.python_version(),
+                   'platform': platform.platform(), 'parameters': vars(args), 'results': results}, f, indent=4)
+    failed = check_startup(results, args.startup_budget / 1e3)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            failed += compare(results, json.load(f), args.threshold)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Selects the targets and the tests affected by the changes made since a git revision.
+
+The changed files are mapped to targets through the build graph of the build directory: the sources of each
+target (CMake file API), the objects compiled from each source (compile_commands.json) and the headers each
+object was compiled with (the Ninja deps log or the depend files of the Makefile generators). The graph is
+cached in the build directory and only read again when one of those files changed"""
+import json
+import logging
+import os
+import re
+from os.path import join, normpath, isabs, exists, basename
+
+from .utils import echo, cmake_exe, cmake_tool
+from . import codemodel, compdb
+
+logger = logging.getLogger(__name__)
+
+graph_file = 'czmake_affected_graph.json'
+make_depend_files = ('compiler_depend.make', 'depend.make')
+# suffix of the depfiles written by the compilers next to the objects (Makefile generators of CMake >= 3.20)
+depfile_suffix = '.d'
+# target types that cannot be built on their own
+unbuildable_types = {'INTERFACE_LIBRARY'}
+
+
+def changed_files(source_directory, revision):
+    """Absolute paths of the files of the git work tree containing ``source_directory`` that differ from
+    ``revision``, including the untracked ones"""
+    import subprocess
+    top = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd=source_directory).decode().strip()
+    diff = subprocess.check_output(['git', 'diff', '--name-only', '--no-renames', '-z', revision, '--'], cwd=top)
+    untracked = subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard', '--full-name', '-z'],
+                                        cwd=top)
+    paths = set(diff.decode().split('\0')) | set(untracked.decode().split('\0'))
+    return sorted(normpath(join(top, path)) for path in paths if path and not path.endswith('/'))
+
+
+def _absolute(build_directory, path):
+    return normpath(path if isabs(path) else join(build_directory, path))
+
+
+def ninja_depends(build_directory):
+    """Maps each output of the Ninja deps log to the files it was built from"""
+    import subprocess
+    from .cmake_cache import load_cache
+    ninja = (load_cache(build_directory) or {}).get('CMAKE_MAKE_PROGRAM', 'ninja')
+    output = subprocess.check_output([ninja, '-C', build_directory, '-t', 'deps'], stderr=subprocess.DEVNULL)
+    result = {}
+    current = None
+    for line in output.decode(errors='replace').splitlines():
+        if not line.strip():
+            current = None
+        elif line[0].isspace():
+            if current is not None:
+                current.append(line.strip())
+        elif ': #deps ' in line:
+            current = result.setdefault(line.split(': #deps ', 1)[0], [])
+    return result
+
+
+def make_depends(path):
+    """Parses the rules of a depend file written by the Makefile generators"""
+    result = {}
+    with open(path, 'r', errors='replace') as f:
+        text = f.read().replace('\\\n', ' ')
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        target, separator, depends = line.partition(': ')
+        if not separator:
+            continue
+        words = [word.replace('\\ ', ' ') for word in re.split(r'(?<!\\)\s+', depends.strip()) if word]
+        result.setdefault(target.strip().replace('\\ ', ' '), []).extend(words)
+    return result
+
+
+def _target_directories(build_directory, index):
+    return sorted({compdb.object_target(build_directory, obj)[1] for objs in index.values() for obj in objs} - {None})
+
+
+def _stamp(paths):
+    result = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            result.append([path, st.st_mtime_ns, st.st_size])
+        except OSError:
+            result.append([path, None, None])
+    return result
+
+
+def graph_inputs(build_directory, index):
+    """Files the graph is built from, their modification invalidates the cached graph"""
+    paths = [join(build_directory, compdb.compile_commands_file), codemodel.reply_index(build_directory) or '',
+             join(build_directory, 'CTestTestfile.cmake')]
+    if exists(join(build_directory, 'build.ninja')):
+        paths.append(join(build_directory, '.ninja_deps'))
+    else:
+        paths += [join(build_directory, directory, name)
+                  for directory in _target_directories(build_directory, index or {}) for name in make_depend_files]
+        paths += [join(build_directory, obj + depfile_suffix) for objs in (index or {}).values() for obj in objs]
+    return paths
+
+
+def list_tests(cfg):
+    """Maps each test of the build directory to the words of its command line"""
+    import subprocess
+    build_directory = cfg['build_directory']
+    if not exists(join(build_directory, 'CTestTestfile.cmake')):
+        return {}
+    ctest = cmake_tool(cfg.get('cmake_exe', None) or cmake_exe, 'ctest')
+    try:
+        output = subprocess.check_output([ctest, '--show-only=json-v1'], cwd=build_directory,
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError) as err:
+        logger.warning('Unable to list the tests (CTest >= 3.14 is required): %s' % err)
+        return {}
+    return {test['name']: test.get('command', []) for test in json.loads(output.decode()).get('tests', [])}
+
+
+def build_graph(cfg, index):
+    """Returns the build graph of the build directory, None without a codemodel"""
+    import subprocess
+    build_directory = cfg['build_directory']
+    model = codemodel.load(build_directory)
+    if model is None:
+        return None
+    files = {}
+    for name, target in model.targets.items():
+        for source in target['sources']:
+            files.setdefault(source, set()).add(name)
+    complete = index is not None
+    if index is not None:
+        objects = {obj: compdb.object_target(build_directory, obj)[0] for objs in index.values() for obj in objs}
+        if exists(join(build_directory, 'build.ninja')):
+            try:
+                depends = ninja_depends(build_directory)
+            except (OSError, subprocess.CalledProcessError) as err:
+                logger.warning('Unable to read the Ninja deps log: %s' % err)
+                depends = {}
+        else:
+            depends = {}
+            for directory in _target_directories(build_directory, index):
+                for name in make_depend_files:
+                    path = join(build_directory, directory, name)
+                    if exists(path):
+                        depends.update(make_depends(path))
+            # the depend files are only updated by the build that follows the compilation, the depfiles at once
+            for obj in objects:
+                path = join(build_directory, obj + depfile_suffix)
+                if exists(path):
+                    depends.update(make_depends(path))
+        for obj, target in objects.items():
+            if target is None:
+                continue
+            inputs = depends.get(obj, None) or depends.get(obj.replace('\\', '/'), None)
+            if not inputs:
+                # not built yet, the headers it includes are unknown
+                complete = False
+                continue
+            for path in inputs:
+                files.setdefault(_absolute(build_directory, path), set()).add(target)
+        for source, objs in index.items():
+            for obj in objs:
+                if objects[obj] is not None:
+                    files.setdefault(source, set()).add(objects[obj])
+    return {
+        'source_directory': model.source_directory,
+        'complete': complete,
+        'files': {path: sorted(targets) for path, targets in files.items()},
+        'targets': {name: {'type': target['type'], 'artifacts': target['artifacts'],
+                           'dependencies': target['dependencies']} for name, target in model.targets.items()},
+        'tests': list_tests(cfg),
+        # a change in the files read by CMake (configure_file() inputs too) may change anything
+        'cmake_inputs': codemodel.load_inputs(build_directory),
+    }
+
+
+def load_graph(cfg):
+    """Returns the build graph, building it only when its inputs changed since it was cached"""
+    build_directory = cfg['build_directory']
+    index = compdb.load_index(build_directory)
+    stamp = _stamp(graph_inputs(build_directory, index))
+    cached = join(build_directory, graph_file)
+    try:
+        with open(cached, 'r') as f:
+            data = json.load(f)
+        if data['stamp'] == stamp:
+            return data['graph']
+    except (OSError, ValueError, KeyError):
+        pass
+    graph = build_graph(cfg, index)
+    tmp = '%s.%d.tmp' % (cached, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'stamp': stamp, 'graph': graph}, f)
+    os.replace(tmp, cached)
+    return graph
+
+
+def reachable(edges, names):
+    """``names`` and all the names reachable from them through ``edges``"""
+    result, stack = set(), list(names)
+    while stack:
+        name = stack.pop()
+        if name not in result:
+            result.add(name)
+            stack.extend(edges.get(name, ()))
+    return result
+
+
+def test_references(command):
+    words = []
+    for word in command:
+        words.append(word)
+        if '=' in word:
+            words.append(word.split('=', 1)[1])
+    return {normpath(word) for word in words if isabs(word)}
+
+
+def select(cfg, revision):
+    """Maps the changes made since ``revision`` to the targets to build and the tests to run. Returns a dict with
+    the ``changed`` files, the ``affected`` targets, the smallest set of ``targets`` building all of them and the
+    ``tests``; when the changes cannot be mapped ``full`` tells why everything has to be built"""
+    graph = load_graph(cfg)
+    build_directory = normpath(cfg['build_directory'])
+    changed = [path for path in changed_files(cfg.get('source_directory', None) or build_directory, revision)
+               if not path.startswith(build_directory + os.sep)]
+    result = {'revision': revision, 'changed': {}, 'ignored': [], 'affected': [], 'targets': [], 'tests': [],
+              'full': None}
+    if graph is None:
+        result['full'] = 'no CMake codemodel in the build directory (CMake >= 3.14 is required)'
+        return result
+    owners = set()
+    cmake_inputs = set(graph.get('cmake_inputs', None) or ())
+    for path in changed:
+        if basename(path).endswith(codemodel.cmake_files) or path in cmake_inputs:
+            result['full'] = '"%s" changed' % path
+        elif path in graph['files']:
+            result['changed'][path] = graph['files'][path]
+            owners.update(graph['files'][path])
+        else:
+            result['ignored'].append(path)
+    if result['full'] is None and result['ignored'] and not graph['complete']:
+        result['full'] = 'the build directory was not fully built, the headers of some sources are unknown'
+    if result['full'] is not None:
+        return result
+    targets = graph['targets']
+    dependents = {}
+    for name, target in targets.items():
+        for dependency in target['dependencies']:
+            dependents.setdefault(dependency, []).append(name)
+    affected = reachable(dependents, owners)
+    wanted = [target for target in cfg.get('cmake_target', None) or [] if target in targets]
+    if wanted:
+        # only what was asked for and what it needs
+        affected &= reachable({name: target['dependencies'] for name, target in targets.items()}, wanted)
+    result['affected'] = sorted(affected)
+    # building a target builds its dependencies first
+    result['targets'] = sorted(name for name in affected if targets[name]['type'] not in unbuildable_types and
+                               not any(dependent in affected for dependent in dependents.get(name, ())))
+    artifacts = {artifact for name in affected for artifact in targets[name]['artifacts']}
+    all_artifacts = {artifact for target in targets.values() for artifact in target['artifacts']}
+    for name, command in sorted(graph['tests'].items()):
+        references = test_references(command)
+        if references & (artifacts | set(changed)):
+            result['tests'].append(name)
+        elif not references & all_artifacts and (affected or result['changed']):
+            # the test does not run a target of the project, it may depend on anything
+            result['tests'].append(name)
+    return result
+
+
+def show(selection, prefix=None):
+    """Prints how the changed files were mapped to targets and tests"""
+    echo('-- Changes since %s:' % selection['revision'], prefix)
+    for path, targets in sorted(selection['changed'].items()):
+        echo('--   %s: %s' % (path, ', '.join(targets)), prefix)
+    for path in selection['ignored']:
+        echo('--   %s: not part of the build' % path, prefix)
+    if selection['full'] is not None:
+        echo('-- Everything is affected: %s' % selection['full'], prefix)
+        return
+    echo('-- Affected targets: %s' % (', '.join(selection['affected']) or 'none'), prefix)
+    echo('-- Targets to build: %s' % (', '.join(selection['targets']) or 'none'), prefix)
+    echo('-- Tests to run: %s' % (', '.join(selection['tests']) or 'none'), prefix)
@@ -0,0 +1,94 @@
+"""Resolves build configurations in process, without parsing the command line, exiting or changing directory::
+
+    from czmake.api import BuildFile, configure_command, build_commands
+
+    build_file = BuildFile.load('build.czmake')
+    for name in build_file.configurations:
+        cfg = build_file.resolve(name, build_type='Release', jobs=8)
+        print(configure_command(cfg), build_commands(cfg))
+
+The keyword arguments of ``resolve`` are the ones of czconfigure, named after their long option
+(``-o KEY=VALUE`` becomes ``options``, which also accepts a dict)"""
+import json
+from os.path import abspath, basename, dirname
+
+from .configure import inheritance_chain, resolve_cfg, configure_command
+from .build import build_command, plan_stages
+from .utils import cmake_exe
+
+__all__ = ['BuildFile', 'configure_command', 'build_commands']
+
+
+class BuildFile:
+    """The content of a build.czmake file. The inheritance chains and the merged configurations are memoized,
+    so resolving many configurations sharing their ancestors only merges each ancestor once"""
+
+    def __init__(self, data, project_directory, configuration_file=None):
+        self.data = data
+        self.project_directory = abspath(project_directory)
+        self.configuration_file = configuration_file
+        self._chains = {}
+        self._merged = {}
+
+    @classmethod
+    def load(cls, configuration_file, project_directory=None):
+        """Reads ``configuration_file``, the project directory defaults to the directory containing it"""
+        with open(configuration_file, 'r') as f:
+            data = json.load(f)
+        return cls(data, project_directory or dirname(abspath(configuration_file)), configuration_file)
+
+    @property
+    def configurations(self):
+        return sorted(self.data.get('configurations', {}))
+
+    @property
+    def default(self):
+        return self.data['default'] if self.data else None
+
+    def inheritance_chain(self, names):
+        key = tuple(names)
+        if key not in self._chains:
+            self._chains[key] = inheritance_chain(self.data, names, self.configuration_file)
+        return list(self._chains[key])
+
+    def resolve(self, names=None, **arguments):
+        """Returns the configuration obtained merging ``names`` (a name or a list of names, the default
+        configuration if None) and their ancestors, with the czconfigure ``arguments`` applied"""
+        if names is None:
+            names = [self.default] if self.default else []
+        elif isinstance(names, str):
+            names = [names]
+        bdirname = '-'.join(['build', basename(self.project_directory)] + list(names))
+        chain = self.inheritance_chain(names) if names else []
+        cfg = resolve_cfg(arguments, self.data, chain, self.project_directory, bdirname, self._merged)
+        cfg['configuration_name'] = '-'.join(names)
+        return cfg
+
+    def resolve_matrix(self, names, **arguments):
+        """Resolves each configuration of ``names`` on its own, for them to be built concurrently: returns a dict
+        mapping each name to its configuration, the job budget given by ``arguments`` is shared among them. The link
+        job pools are not, their size is part of the configuration of each build directory"""
+        result = {name: self.resolve(name, **arguments) for name in names}
+        for cfg in result.values():
+            cfg['matrix_share'] = len(result)
+        return result
+
+
+def build_commands(cfg):
+    """The command lines run, in this order, to build a resolved configuration: ``cmake --build`` for the targets,
+    ``ctest`` for the test stage and ``cpack`` for the package stage. czmake runs the latter on the project
+    installed in a staging directory, once per generator (see czmake.packaging)"""
+    from os.path import join
+    from .packaging import cpack_config_file
+    from .testing import test_command
+    from .utils import cmake_tool
+    commands = []
+    for targets in plan_stages(cfg, cfg.get('cmake_target', None)):
+        if targets == ['test']:
+            commands.append(test_command(cfg))
+        elif targets == ['package']:
+            commands.append([cmake_tool(cfg.get('cmake_exe', cmake_exe), 'cpack'),
+                             '--config', join(cfg['build_directory'], cpack_config_file)])
+        else:
+            commands.append(build_command(cfg, targets))
+    return commands
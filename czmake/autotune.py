@@ -0,0 +1,246 @@
+"""Searches the fastest building variant of a configuration.
+
+The variants are declared in the configuration itself, as alternative configuration fragments for each axis::
+
+    "release": {
+        "options": {"CMAKE_BUILD_TYPE": "Release"},
+        "autotune": {
+            "variants": {
+                "unity": {"off": {}, "batch8": {"options": {"CMAKE_UNITY_BUILD": true,
+                                                            "CMAKE_UNITY_BUILD_BATCH_SIZE": 8}}},
+                "linker": {"default": {}, "mold": {"options": {"CMAKE_LINKER_TYPE": "MOLD"}}},
+                "generator": [{"generator": "Unix Makefiles"}, {"generator": "Ninja"}]
+            },
+            "objective": "total",
+            "touch": ["src/main.cpp"]
+        }
+    }
+
+Each variant is configured and built from scratch in its own build directory, then rebuilt after touching
+the ``touch`` files (by default the first source file of compile_commands.json). The timings are cached, so
+that later runs only build the variants they did not see yet, and the fastest variant is written back to the
+configuration file as a configuration inheriting from the tuned one"""
+import json
+import logging
+import os
+import time
+from copy import deepcopy
+from itertools import product
+from os.path import join, exists, isabs
+
+from .utils import echo, write_if_different
+
+logger = logging.getLogger(__name__)
+
+results_file = 'autotune.json'
+default_max_variants = 16
+objectives = ('clean', 'incremental', 'total')
+# configuration entries that do not change what gets built
+ignored_keys = {'build', 'build_directory', 'clean', 'extra_args', 'launch_ccmake', 'force_configure', 'profile',
+                'report', 'trace', 'warm_compiler_cache', 'output', 'autotune', 'configuration_name', 'affected_since'}
+
+
+def merge(original, fragment):
+    """Recursively applies ``fragment`` to ``original``, unlike utils.update_dict false values override too"""
+    for key, value in fragment.items():
+        if isinstance(value, dict) and isinstance(original.get(key, None), dict):
+            merge(original[key], value)
+        else:
+            original[key] = deepcopy(value)
+    return original
+
+
+def inheritable(fragment):
+    """Returns ``fragment`` as the entries of a configuration inheriting from the tuned one. The inherited
+    configurations are merged with utils.update_dict, which ignores false values: the false CMake options are
+    written as the CMake strings "OFF" and "0", None is returned if another false value would be lost"""
+    result = {}
+    for key, value in fragment.items():
+        if key == 'options' and isinstance(value, dict):
+            options = {}
+            for option, option_value in value.items():
+                if option_value is False:
+                    option_value = 'OFF'
+                elif option_value == 0 and not isinstance(option_value, bool):
+                    option_value = '0'
+                elif not option_value:
+                    return None
+                options[option] = option_value
+            result[key] = options
+        elif isinstance(value, dict):
+            result[key] = inheritable(value)
+            if result[key] is None:
+                return None
+        elif not value:
+            return None
+        else:
+            result[key] = deepcopy(value)
+    return result
+
+
+def axes(spec):
+    """Returns the variant axes as a list of (axis, [(label, fragment), ...])"""
+    result = []
+    for axis, alternatives in spec.get('variants', {}).items():
+        if isinstance(alternatives, dict):
+            alternatives = list(alternatives.items())
+        else:
+            alternatives = [(str(i), fragment) for i, fragment in enumerate(alternatives)]
+        if alternatives:
+            result.append((axis, alternatives))
+    return result
+
+
+def variant_key(cfg, fragment):
+    import hashlib
+    base = {key: value for key, value in cfg.items() if key not in ignored_keys}
+    return hashlib.md5(json.dumps([base, fragment], sort_keys=True).encode()).hexdigest()[:16]
+
+
+def score(result, objective):
+    if result.get('failed', False):
+        return float('inf')
+    elif objective == 'clean':
+        return result['clean']
+    elif objective == 'incremental':
+        return result['incremental']
+    return result['clean'] + result['incremental']
+
+
+def touch_files(cfg, spec, build_directory):
+    if spec.get('touch', None):
+        return [path if isabs(path) else join(cfg['project_directory'], path) for path in spec['touch']]
+    from .compdb import load_index
+    index = load_index(build_directory) or {}
+    return sorted(index)[:1]
+
+
+def measure(cfg, fragment, spec, directory, prefix):
+    """Configures and builds ``cfg`` with ``fragment`` applied from scratch, then again after touching some sources,
+    returns the timings"""
+    from .cleanup import remove_async
+    from .configure import configure
+    from .build import build, sequential_targets
+    variant = merge(deepcopy(cfg), fragment)
+    variant.update(build_directory=directory, clean=True, build=True, launch_ccmake=False, force_configure=True,
+                   test=False, affected_since=None, profile=False, report=None, trace=None,
+                   output=cfg.get('output', None) or 'quiet')
+    variant['cmake_target'] = [target for target in variant.get('cmake_target', None) or []
+                               if target not in sequential_targets] or None
+    try:
+        start = time.time()
+        configure(variant, prefix=prefix)
+        configure_time = time.time() - start
+        start = time.time()
+        build(variant, prefix=prefix)
+        clean_time = time.time() - start
+        touched = touch_files(cfg, spec, directory)
+        saved = {path: os.stat(path) for path in touched}
+        try:
+            for path in touched:
+                os.utime(path)
+            start = time.time()
+            build(variant, prefix=prefix)
+            incremental_time = time.time() - start
+        finally:
+            # do not make the other build directories rebuild the touched files
+            for path, st in saved.items():
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        return {'configure': configure_time, 'clean': configure_time + clean_time, 'incremental': incremental_time}
+    except Exception as err:
+        logger.warning('Variant %s failed: %s' % (prefix, err))
+        return {'failed': True, 'error': str(err)}
+    finally:
+        exists(directory) and remove_async(directory)
+
+
+def candidates(spec_axes, max_variants):
+    """Yields the variants to try as tuples of alternative indexes: all of them if they are at most
+    ``max_variants``, otherwise one axis at a time keeping the best alternative found so far for the others.
+    The generator receives (through send) the index of the best variant tried so far"""
+    sizes = [len(alternatives) for _, alternatives in spec_axes]
+    total = 1
+    for size in sizes:
+        total *= size
+    if total <= max_variants:
+        for variant in product(*[range(size) for size in sizes]):
+            yield variant
+        return
+    best = tuple(0 for _ in sizes)
+    best = (yield best) or best
+    for axis, size in enumerate(sizes):
+        for alternative in range(1, size):
+            variant = best[:axis] + (alternative,) + best[axis + 1:]
+            best = (yield variant) or best
+
+
+def tune(cfg, configuration_file, max_variants=None, prefix=None):
+    """Runs the search for the configuration ``cfg`` and writes the fastest variant to ``configuration_file``,
+    returns the name of the new configuration (None if no variant is declared)"""
+    spec = cfg.get('autotune', None) or {}
+    spec_axes = axes(spec)
+    if not spec_axes:
+        logger.warning('Build configuration "%s" does not declare any "autotune" variant' % cfg['configuration_name'])
+        return None
+    objective = spec.get('objective', 'total')
+    if objective not in objectives:
+        raise ValueError('Unknown autotune objective "%s", expected one of %s' % (objective, ', '.join(objectives)))
+    root = cfg['build_directory'] + '-autotune'
+    os.makedirs(root, exist_ok=True)
+    results_path = join(root, results_file)
+    try:
+        with open(results_path, 'r') as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        results = {}
+
+    built = 0
+    best, best_score = None, float('inf')
+    search = candidates(spec_axes, max_variants or spec.get('max_variants', None) or default_max_variants)
+    variant = next(search)
+    while True:
+        label = ','.join('%s=%s' % (axis, alternatives[i][0]) for (axis, alternatives), i in zip(spec_axes, variant))
+        fragment = {}
+        for (_, alternatives), i in zip(spec_axes, variant):
+            merge(fragment, alternatives[i][1])
+        key = variant_key(cfg, fragment)
+        if key in results:
+            echo('-- %s: cached' % label, prefix)
+        else:
+            built += 1
+            echo('-- %s: building' % label, prefix)
+            results[key] = dict(measure(cfg, fragment, spec, join(root, key), label), label=label, fragment=fragment)
+            write_if_different(results_path, json.dumps(results, indent=4))
+        result = results[key]
+        if not result.get('failed', False):
+            echo('-- %s: clean %.2f s, incremental %.2f s' % (label, result['clean'], result['incremental']), prefix)
+        if score(result, objective) < best_score:
+            best, best_score = (variant, fragment, result), score(result, objective)
+        try:
+            variant = search.send(best[0] if best else None)
+        except StopIteration:
+            break
+    if best is None:
+        raise RuntimeError('Every autotune variant of "%s" failed' % cfg['configuration_name'])
+    variant, fragment, result = best
+    name = spec.get('name', None) or '%s-tuned' % cfg['configuration_name']
+    echo('-- Fastest variant: %s (%s objective %.2f s, %d variants built), saved as configuration "%s"' % (
+        result['label'], objective, best_score, built, name), prefix)
+    with open(configuration_file, 'r') as f:
+        build_cfg = json.load(f)
+    tuned = inheritable(fragment)
+    if tuned is not None:
+        tuned = dict(inherits=cfg['configuration_name'], **tuned)
+    else:
+        # a false value would not override the inherited one, the tuned configuration is written in full instead
+        from .configure import inheritance_chain
+        from .utils import update_dict
+        tuned = {}
+        for configuration in inheritance_chain(build_cfg, [cfg['configuration_name']], configuration_file):
+            update_dict(tuned, deepcopy(build_cfg['configurations'][configuration]))
+        for key in ('inherits', 'autotune'):
+            tuned.pop(key, None)
+        merge(tuned, fragment)
+    build_cfg['configurations'][name] = tuned
+    write_if_different(configuration_file, json.dumps(build_cfg, indent=4) + '\n')
+    return name
@@ -1,37 +1,125 @@
 import argparse
 import json
 import logging
-import os
-import platform
 import sys
-from multiprocessing import cpu_count
-from os.path import join, exists
-from subprocess import check_call
+import time
+from os.path import join, exists, abspath
 
-from .utils import str2bool, cmake_exe, update_dict, cache_file
+from .utils import str2bool, cmake_exe, update_dict, cache_file, fork, echo, cmake_version
+from .jobs import add_job_arguments, build_env, native_args, native_tool
+from .output import Session, add_output_arguments
+from .testing import add_test_arguments
+from .packaging import add_package_arguments
+from . import report, compiler_cache, distribute, cleanup
 
 logger = logging.getLogger(__name__)
 
-def fork(*args, **kwargs):
-    sys.stdout.write(' '.join(args[0]) + '\n')
-    return check_call(*args, **kwargs)
-
 def argv_parse():
     parser = argparse.ArgumentParser()
     parser.add_argument("--install", type=str2bool, nargs='?', const=True, metavar='(true|false)',
                         help="Calls the install target at the end of the build process")
     parser.add_argument("--package", type=str2bool, nargs='?', const=True, metavar='(true|false)',
                         help="Run CPack at the end of the build process")
-    parser.add_argument("-j", "--jobs", metavar="JOBS", type=int,
-                        help="maximum number of concurrent jobs (only works if native build system has support for '-j N' command line parameter)")
+    add_job_arguments(parser)
     parser.add_argument("-T", "--cmake-target", nargs='*', help="build specified cmake target(s)")
     parser.add_argument("-b", "--build-directory", help="directory in which the build will take place", metavar='BUILD_DIR', default='.')
+    add_postprocess_arguments(parser)
+    add_report_arguments(parser)
+    add_output_arguments(parser)
+    add_test_arguments(parser)
+    add_package_arguments(parser)
+    add_affected_arguments(parser)
+    parser.add_argument("--list-affected", action='store_true',
+                        help="with --affected-since, only list the changed files and the targets and tests they "
+                             "affect")
+    parser.add_argument("--file", metavar='SOURCE_FILE',
+                        help="only compile SOURCE_FILE (with --link, build the smallest target it belongs to)")
+    parser.add_argument("--link", action='store_true', help="with --file, also link the target owning the file")
+    parser.add_argument("--watch", action='store_true',
+                        help="keep running and rebuild the targets affected by each change in the source tree")
+    parser.add_argument("--debounce", type=int, default=300, metavar='MS',
+                        help="with --watch, wait until no file changed for MS milliseconds before building")
+    parser.add_argument("--socket", nargs='?', const='', metavar='PATH',
+                        help="with --watch, accept build requests from editors on the unix socket PATH "
+                             "(default BUILD_DIR/czmake.sock)")
     parser.add_argument("extra_args", nargs='*', help="extra arguments to pass to CMake or native build system")
     args = parser.parse_args()
     return args
 
 
-def build(configuration):
+def add_postprocess_arguments(parser):
+    parser.add_argument("--strip", type=str2bool, nargs='?', const=True, metavar='(true|false)',
+                        help="strip the installed binaries that changed since the last run")
+    parser.add_argument("--upx", type=str2bool, nargs='?', const=True, metavar='(true|false)',
+                        help="compress the installed binaries that changed since the last run with upx")
+    parser.add_argument("--upx-cache", nargs='?', const='default', metavar='DIR',
+                        help="reuse the compressed binaries stored in DIR (default ~/.cache/czmake/upx, "
+                             "CZMAKE_UPX_CACHE) for identical inputs")
+
+
+def postprocess(cfg, prefix=None):
+    from .postprocess import postprocess, installed_files, upx_cache_directory, state_directory
+    cache_directory = cfg.get('upx_cache', None) if cfg.get('upx', False) else None
+    if cache_directory == 'default':
+        cache_directory = upx_cache_directory
+    postprocess(installed_files(cfg['build_directory']), strip=cfg.get('strip', False), upx=cfg.get('upx', False),
+                workers=cfg.get('jobs', None), cache_directory=cache_directory, prefix=prefix,
+                directory=join(cfg['build_directory'], state_directory))
+
+
+def add_affected_arguments(parser):
+    parser.add_argument("--affected-since", metavar='REVISION',
+                        help="only build the targets and run the tests affected by the changes made in the git work "
+                             "tree since REVISION (e.g. origin/master)")
+
+
+def add_report_arguments(parser):
+    parser.add_argument("--report", type=int, nargs='?', const=10, metavar='N',
+                        help="print the time spent in each stage and the N slowest translation units and targets "
+                             "(the latter only with the Ninja generator)")
+    parser.add_argument("--trace", metavar='TRACE_FILE', type=abspath,
+                        help="export the timings of the run in Chrome/Perfetto trace format to TRACE_FILE")
+    parser.add_argument("--history", type=int, nargs='?', const=10, metavar='N',
+                        help="print the wall time of the last N runs of the build configuration and exit")
+
+
+# targets that depend on the whole build being complete and have to run one at a time, in this order
+sequential_targets = ['install', 'package']
+
+
+def build_stages(targets, cmake_exe=cmake_exe):
+    targets = list(dict.fromkeys(targets or []))
+    parallel = [target for target in targets if target not in sequential_targets]
+    stages = []
+    if cmake_version(cmake_exe) >= (3, 15):
+        # 'cmake --build' accepts multiple targets since 3.15, so that the native build tool schedules them together
+        if parallel:
+            stages.append(parallel)
+    else:
+        stages += [[target] for target in parallel]
+    stages += [[target] for target in sequential_targets if target in targets]
+    return stages
+
+
+def plan_stages(cfg, targets, selection=None):
+    """The stages run by build(), in order: the lists of targets built with cmake --build ([] for the default
+    targets), ['test'] for the CTest stage and ['package'] for the packaging stage. With an affected ``selection``
+    nothing is built when no target is affected"""
+    stages = build_stages(targets, cfg.get('cmake_exe', cmake_exe))
+    if selection is None:
+        stages = stages or [[]]
+    if selection is None and stages[0] and stages[0][0] in sequential_targets:
+        # the default targets are built first, so that they are tested before the install target runs and the
+        # packaging stage, unlike the package target, does not build them
+        stages.insert(0, [])
+    if cfg.get('test', False):
+        # what gets installed or packaged has to pass the tests first
+        stages.insert(next((i for i, stage in enumerate(stages) if stage and stage[0] in sequential_targets),
+                           len(stages)), ['test'])
+    return stages
+
+
+def load_cfg(configuration):
     cfile = join(configuration['build_directory'], cache_file)
     if exists(cfile):
         with open(cfile, 'r') as f:
@@ -39,42 +127,159 @@ def build(configuration):
     else:
         cfg = {}
     update_dict(cfg, configuration)
+    return cfg
+
+
+def build_command(cfg, targets):
+    build_cmd = [cfg.get('cmake_exe', cmake_exe), '--build', cfg['build_directory']]
+    if targets:
+        build_cmd += ['--target'] + list(targets)
+    extra_args = native_args(cfg) + (cfg.get('extra_args', None) or [])
+    if extra_args:
+        build_cmd += ['--'] + extra_args
+    return build_cmd
 
-    env = os.environ
-    if platform.system() != 'Windows' and 'MAKEFLAGS' not in os.environ:
-        env['MAKEFLAGS'] = "-j%d" % cpu_count()
-    extra_args = ['--']
-    if cfg.get('jobs', None):
-        extra_args += ['-j%d' % cfg['jobs']]
-    if cfg.get('extra_args', None):
-        extra_args += cfg['extra_args']
-    if len(extra_args) == 1:
-        extra_args = []
-    if cfg.get('cmake_target', None) and len(cfg['cmake_target']) > 0:
-        for target in cfg['cmake_target']:
-            build_cmd = [cfg['cmake_exe'], '--build', cfg['build_directory'], '--target', target] + extra_args
-            fork(build_cmd, env=env)
+
+def build_file(configuration, path, link=False, prefix=None):
+    """Builds only the object file compiled from the source file ``path`` or, if ``link`` is True,
+    the smallest target that has it among its sources"""
+    from . import compdb, codemodel
+    cfg = load_cfg(configuration)
+    path = abspath(path)
+    objects = compdb.objects(cfg['build_directory'], path)
+    if objects is None:
+        raise ValueError('"%s" not found, configure with CMAKE_EXPORT_COMPILE_COMMANDS=ON' %
+                         join(cfg['build_directory'], compdb.compile_commands_file))
+    elif not objects:
+        raise ValueError('"%s" is not compiled by any target' % path)
+    env = build_env(cfg)
+    model = codemodel.load(cfg['build_directory'])
+    owners = model.owners(path) if model else []
+    if not owners:
+        owners = [name for name in (compdb.object_target(cfg['build_directory'], obj)[0] for obj in objects) if name]
+    if link:
+        if not owners:
+            raise ValueError('No target of the codemodel has "%s" among its sources, nothing to link' % path)
+        smallest = min(owners, key=lambda name: len(model.targets[name]['sources']) if model else 0)
+        fork(build_command(cfg, [smallest]), prefix=prefix, env=env)
+    elif native_tool(cfg['build_directory']) == 'ninja':
+        fork(build_command(cfg, objects), prefix=prefix, env=env)
     else:
-        build_cmd = [cfg.get('cmake_exe', cmake_exe), '--build', cfg['build_directory']] + extra_args
-        fork(build_cmd, env=env)
+        from .cmake_cache import load_cache
+        make_program = (load_cache(cfg['build_directory']) or {}).get('CMAKE_MAKE_PROGRAM', 'make')
+        for obj in objects:
+            cmd = compdb.make_command(cfg['build_directory'], obj, make_program)
+            if cmd is None:
+                logger.warning('Cannot build "%s" on its own with this generator, building its target instead' % obj)
+                cmd = build_command(cfg, owners)
+            fork(cmd, prefix=prefix, env=env)
+
+
+def test_stage(cfg, prefix=None, output=None, tests=None):
+    from .testing import run_tests
+    start = time.time()
+    count = run_tests(cfg, prefix, output, tests)
+    echo('-- Stage "test" finished in %.2f s' % (time.time() - start), prefix)
+    return report.stage('test', start, tests=count)
+
+
+def package_stage(cfg, prefix=None, output=None):
+    from .packaging import package
+    start = time.time()
+    packages = package(cfg, prefix, output)
+    echo('-- Stage "package" finished in %.2f s' % (time.time() - start), prefix)
+    return report.stage('package', start, packages=packages)
+
+
+def affected_selection(cfg, prefix=None):
+    """The targets and tests affected by the changes since cfg['affected_since'], None if everything is"""
+    from .affected import select
+    selection = select(cfg, cfg['affected_since'])
+    if selection['full'] is not None:
+        echo('-- Building everything: %s' % selection['full'], prefix)
+        return None
+    echo('-- %d files changed since %s affect %d targets and %d tests' % (
+        len(selection['changed']) + len(selection['ignored']), cfg['affected_since'], len(selection['affected']),
+        len(selection['tests'])), prefix)
+    return selection
+
+
+def build(configuration, prefix=None):
+    cfg = load_cfg(configuration)
+
+    cleanup.mark_used(cfg['build_directory'])
+    env = build_env(cfg)
+    cache_stats = compiler_cache.stats(cfg, env)
+    distribute.reset_log(cfg)
+    result = []
+    targets = cfg.get('cmake_target', None)
+    selection = affected_selection(cfg, prefix) if cfg.get('affected_since', None) else None
+    if selection is not None:
+        targets = selection['targets'] + [target for target in targets or [] if target in sequential_targets]
+    tests = selection['tests'] if selection is not None else None
+    with Session(cfg['build_directory'], 'build', cfg.get('output', None), prefix) as output:
+        for targets in plan_stages(cfg, targets, selection):
+            if targets == ['test']:
+                result.append(test_stage(cfg, prefix, output, tests))
+                continue
+            if targets == ['package']:
+                result.append(package_stage(cfg, prefix, output))
+                continue
+            offset = report.ninja_log_offset(cfg['build_directory'])
+            start = time.time()
+            fork(build_command(cfg, targets), prefix=prefix, output=output, env=env)
+            result.append(report.stage(' '.join(targets) or 'all', start,
+                                       edges=report.read_ninja_log(cfg['build_directory'], offset)))
+            echo('-- Stage "%s" finished in %.2f s' % (result[-1]['name'], result[-1]['duration']), prefix)
+            if 'install' in targets and (cfg.get('strip', False) or cfg.get('upx', False)):
+                start = time.time()
+                postprocess(cfg, prefix)
+                result.append(report.stage('postprocess', start))
+    compiler_cache.summarize(cfg, cache_stats, compiler_cache.stats(cfg, env), result, prefix)
+    distribute.summarize(cfg, prefix)
+    return result
 
 
 def build_cli():
     logging.basicConfig(format='%(levelname)s: %(message)s')
+    if sys.argv[1:2] == ['gc']:
+        cleanup.gc_cli(sys.argv[2:])
+        return
     cfg = vars(argv_parse())
     if isinstance(cfg['cmake_target'], str):
-        cfg['cmake_target'] = set(cfg['cmake_target'])
+        cfg['cmake_target'] = [cfg['cmake_target']]
     elif cfg['cmake_target']:
-        cfg['cmake_target'] = set(cfg['cmake_target'])
+        cfg['cmake_target'] = list(dict.fromkeys(cfg['cmake_target']))
     if cfg['package']:
-        cfg['cmake_target'] = cfg.get('cmake_target', []) + ['package']
+        cfg['cmake_target'] = (cfg['cmake_target'] or []) + ['package']
     elif cfg['package'] == False and cfg['cmake_target']:
         cfg['cmake_target'] = [target for target in cfg['cmake_target'] if target != 'package']
     if cfg['install']:
-        cfg['cmake_target'] = cfg.get('cmake_target', []) + ['install']
+        cfg['cmake_target'] = (cfg['cmake_target'] or []) + ['install']
     elif cfg['install'] == False and cfg['cmake_target']:
         cfg['cmake_target'] = [target for target in cfg['cmake_target'] if target != 'install']
-    build(cfg)
+    cfg['build_directory'] = abspath(cfg['build_directory'])
+    if cfg['history']:
+        report.print_history(load_cfg(cfg), cfg['history'])
+        return
+    if cfg['list_affected']:
+        from .affected import select, show
+        if not cfg['affected_since']:
+            raise ValueError('--list-affected requires --affected-since')
+        show(select(load_cfg(cfg), cfg['affected_since']))
+        return
+    if cfg['file']:
+        build_file(cfg, cfg['file'], cfg['link'])
+        return
+    if cfg['watch']:
+        from .watch import watch
+        socket_path = cfg['socket']
+        if socket_path == '':
+            socket_path = join(cfg['build_directory'], 'czmake.sock')
+        watch(load_cfg(cfg), cfg['debounce'] / 1000.0, socket_path)
+        return
+    stages = build(cfg)
+    report.finish(load_cfg(cfg), stages)
 
 def run(): 
     build_cli()
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import sys
+import time
+from os.path import join, exists, basename, dirname, abspath, isdir
+
+from .utils import echo, touch, cache_file, fingerprint_file
+
+logger = logging.getLogger(__name__)
+
+trash_prefix = '.czmake-trash-'
+last_used_file = 'czmake_last_used'
+size_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def remove_async(path):
+    """Moves ``path`` out of the way at once and deletes it in a detached process, so that the caller does not wait
+    for large trees to be deleted. Leftovers of deletions that were interrupted are removed as well"""
+    import subprocess
+    path = abspath(path)
+    parent = dirname(path)
+    trash = join(parent, '%s%s-%d-%d' % (trash_prefix, basename(path), os.getpid(), time.time() * 1000))
+    os.rename(path, trash)
+    leftovers = [join(parent, name) for name in os.listdir(parent) if name.startswith(trash_prefix)]
+    kwargs = {'creationflags': 0x00000008} if os.name == 'nt' else {'start_new_session': True}
+    subprocess.Popen([sys.executable, '-c', 'import shutil, sys\nfor path in sys.argv[1:]: '
+                                            'shutil.rmtree(path, ignore_errors=True)'] + leftovers,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True,
+                     **kwargs)
+
+
+def mark_used(build_directory):
+    touch(join(build_directory, last_used_file))
+
+
+def last_used(build_directory):
+    times = []
+    for name in (last_used_file, '.ninja_log', fingerprint_file, cache_file, 'CMakeCache.txt'):
+        try:
+            times.append(os.stat(join(build_directory, name)).st_mtime)
+        except OSError:
+            pass
+    return max(times) if times else os.stat(build_directory).st_mtime
+
+
+def disk_usage(path):
+    """Bytes used on disk by the tree at ``path`` (symbolic links are not followed)"""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                total += st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    return total
+
+
+def parse_size(value):
+    """Parses sizes like '500M' or '20G' (binary units) into bytes"""
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    unit = value[-1:] if value[-1:] in size_units else ''
+    return int(float(value[:len(value) - len(unit)]) * size_units[unit])
+
+
+def format_size(size):
+    for unit in ('T', 'G', 'M', 'K'):
+        if size >= size_units[unit]:
+            return '%.1f %siB' % (size / size_units[unit], unit)
+    return '%d B' % size
+
+
+def build_directories(project_directory, configuration_file=None):
+    """Returns a dict mapping the build directories of the project to the name of their configuration: the ones
+    inside the project directory and the ones of the configurations of ``configuration_file``"""
+    result = {}
+    candidates = [join(project_directory, name) for name in os.listdir(project_directory)
+                  if not name.startswith(trash_prefix)]
+    if configuration_file and exists(configuration_file):
+        from .api import BuildFile
+        build_file = BuildFile.load(configuration_file, project_directory)
+        for name in build_file.configurations:
+            try:
+                candidates.append(build_file.resolve(name)['build_directory'])
+            except (KeyError, ValueError):
+                pass
+    for path in candidates:
+        path = abspath(path)
+        if path in result or not isdir(path) or not exists(join(path, 'CMakeCache.txt')):
+            continue
+        try:
+            with open(join(path, cache_file), 'r') as f:
+                cfg = json.load(f)
+        except (OSError, ValueError):
+            cfg = {}
+        if cfg.get('project_directory', project_directory) != project_directory:
+            continue
+        result[path] = cfg.get('configuration_name', None) or ''
+    return result
+
+
+def gc(project_directory, configuration_file=None, budget=None, dry_run=False):
+    """Lists the build directories of the project and, if ``budget`` (bytes) is given, deletes the least recently
+    used ones until the others fit in it. Returns the deleted directories"""
+    directories = build_directories(project_directory, configuration_file)
+    entries = sorted(((last_used(path), disk_usage(path), path, name) for path, name in directories.items()),
+                     reverse=True)
+    total = sum(size for _, size, _, _ in entries)
+    removed = []
+    if budget is not None:
+        kept = total
+        for used, size, path, name in reversed(entries):
+            if kept <= budget:
+                break
+            removed.append(path)
+            kept -= size
+    for used, size, path, name in entries:
+        echo('%10s  %s  %s%s%s' % (format_size(size), time.strftime('%Y-%m-%d %H:%M', time.localtime(used)), path,
+                                  ' (%s)' % name if name else '', '  [removed]' if path in removed else ''))
+    echo('-- %d build directories, %s' % (len(entries), format_size(total)))
+    if not dry_run:
+        for path in removed:
+            remove_async(path)
+    if removed:
+        echo('-- %s %d build directories, %s freed' % (
+            'Would remove' if dry_run else 'Removing', len(removed),
+            format_size(sum(size for _, size, path, _ in entries if path in removed))))
+    return removed
+
+
+def gc_cli(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='czmake gc',
+                                     description='list the build directories of the project and delete the least '
+                                                 'recently used ones to fit a disk budget')
+    parser.add_argument("-f", "--configuration-file", default=join(os.getcwd(), 'build.czmake'),
+                        help="build configuration file of the project (default ./build.czmake)",
+                        metavar='CONFIGURATION_FILE')
+    parser.add_argument("-p", "--project-directory",
+                        help="root directory of the project (defaults to the directory of the build configuration file)")
+    parser.add_argument("--budget", type=parse_size, metavar='SIZE',
+                        help="delete the least recently used build directories until the others take at most SIZE "
+                             "(e.g. 50G)")
+    parser.add_argument("-n", "--dry-run", action='store_true', help="only show what would be deleted")
+    args = parser.parse_args(argv)
+    project_directory = abspath(args.project_directory or dirname(abspath(args.configuration_file)))
+    gc(project_directory, abspath(args.configuration_file), args.budget, args.dry_run)
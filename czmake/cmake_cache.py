@@ -1,3 +1,6 @@
+from os.path import join
+
+
 class ParseError(Exception):
     """Exception raised for errors during parse.
 
@@ -13,23 +16,30 @@ class ParseError(Exception):
     def __repr__(self):
         return 'Error at line %d: %s' % (self.line, self.message)
 
+    __str__ = __repr__
+
+
 class CMakeCache(dict):
-    
-    falsy_values = ['', '0', 'OFF', 'NO', 'FALSE', 'N', 'IGNORE', 'NOTFOUND']
+    """Maps each cache entry name to its raw string value, as written in CMakeCache.txt.
+
+    Entry types are kept in ``types``, the names of the entries marked as advanced in ``advanced``
+    and, when read with ``keep_help=True``, the ``//`` help strings in ``helps``.
+    """
+
+    falsy_values = frozenset(['', '0', 'OFF', 'NO', 'FALSE', 'N', 'IGNORE', 'NOTFOUND'])
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.types = {}
+        self.helps = {}
+        self.advanced = set()
 
     @staticmethod
     def to_bool(val):
         val = val.upper()
-        for ref in CMakeCache.falsy_values:
-            if ref == val:
-                return False
-        else:
-            if val.endswith('NOTFOUND'):
-                return False
-            else:
-                return True         
+        return not (val in CMakeCache.falsy_values or val.endswith('-NOTFOUND'))
 
-    def get(self, key, default):
+    def get(self, key, default=None):
         if key in self:
             if isinstance(default, bool):
                 return CMakeCache.to_bool(self[key])
@@ -38,17 +48,76 @@ class CMakeCache(dict):
         else:
             return default
 
-def read_cache(cmake_cache_file):
+    def typed(self, key):
+        value = self[key]
+        return CMakeCache.to_bool(value) if self.types.get(key, None) == 'BOOL' else value
+
+    def is_internal(self, key):
+        return self.types.get(key, None) in ('INTERNAL', 'STATIC')
+
+    def is_advanced(self, key):
+        return key in self.advanced
+
+    def matches(self, key, value):
+        if key not in self:
+            return False
+        elif isinstance(value, bool):
+            return CMakeCache.to_bool(self[key]) == value
+        else:
+            return self[key] == str(value)
+
+    def diff(self, options):
+        """Returns the subset of ``options`` (a dict in the format of ``cfg['options']``, keys may carry
+        a ``:TYPE`` suffix) whose value is missing from or different than the one stored in the cache"""
+        return {key: value for key, value in options.items() if not self.matches(key.partition(':')[0], value)}
+
+
+def read_cache(cmake_cache_file, keep_help=False):
+    """Parses the content of a CMakeCache.txt file, ``cmake_cache_file`` is an iterable of lines"""
     result = CMakeCache()
-    line_index = 0
-    for line in cmake_cache_file:
-        index = line.find(' = ')
-        if index < 0:
-            print(line)
-            raise ParseError(line_index, 'Cannot parse entry') 
-        key, value = line[:index], line[index+3:-1]
-        result[key] = value
-        line_index += 1
+    types = result.types
+    help_lines = []
+    for line_index, line in enumerate(cmake_cache_file):
+        line = line.rstrip('\r\n')
+        if not line or line[0] == '#':
+            continue
+        elif line.startswith('//'):
+            if keep_help:
+                help_lines.append(line[2:])
+            continue
+        if line[0] == '"':
+            end = line.find('"', 1)
+            if end < 0:
+                raise ParseError(line_index, 'Unterminated quoted key')
+            key, head_end = line[1:end], end + 1
+        else:
+            key, head_end = None, 0
+        eq = line.find('=', head_end)
+        if eq < 0:
+            raise ParseError(line_index, 'Cannot parse entry')
+        colon = line.find(':', head_end, eq)
+        if key is None:
+            key = line[:colon if colon >= 0 else eq].strip()
+        ty = line[colon + 1:eq] if colon >= 0 else 'UNINITIALIZED'
+        value = line[eq + 1:]
+        if len(value) > 1 and value[0] == "'" and value[-1] == "'":
+            value = value[1:-1]
+        if ty == 'INTERNAL' and key.endswith('-ADVANCED'):
+            if CMakeCache.to_bool(value):
+                result.advanced.add(key[:-9])
+        else:
+            result[key] = value
+            types[key] = ty
+        if help_lines:
+            result.helps[key] = '\n'.join(help_lines)
+            help_lines = []
     return result
 
-            
\ No newline at end of file
+
+def load_cache(build_directory, keep_help=False):
+    """Reads the CMakeCache.txt file in ``build_directory``, returns None if it does not exist"""
+    try:
+        with open(join(build_directory, 'CMakeCache.txt'), 'r', errors='replace') as f:
+            return read_cache(f, keep_help)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,126 @@
+import json
+import os
+from os.path import join, exists, isabs, normpath
+
+api_directory = join('.cmake', 'api', 'v1')
+query_file = join(api_directory, 'query', 'codemodel-v2')
+cmake_files_query_file = join(api_directory, 'query', 'cmakeFiles-v1')
+# files whose change requires CMake to regenerate the build system, whatever the file API says
+cmake_files = ('CMakeLists.txt', '.cmake', 'externals.json')
+
+
+def request(build_directory):
+    """Asks CMake (>= 3.14) to write the codemodel of the project and the list of its CMake inputs at the next
+    configure through the file API, returns True if a query was not there yet (and the configure step has to run
+    to answer it)"""
+    missing = [path for path in (join(build_directory, query_file), join(build_directory, cmake_files_query_file))
+               if not exists(path)]
+    if not missing:
+        return False
+    os.makedirs(join(build_directory, api_directory, 'query'), exist_ok=True)
+    for path in missing:
+        open(path, 'w').close()
+    return True
+
+
+class CodeModel:
+    """Targets of a configured build directory, as described by the CMake file API.
+
+    ``targets`` maps each target name to a dict with its ``type``, the absolute paths of its ``sources``
+    and ``artifacts`` and the names of the targets it directly depends on (``dependencies``)"""
+
+    def __init__(self, source_directory, build_directory, targets):
+        self.source_directory = source_directory
+        self.build_directory = build_directory
+        self.targets = targets
+        self._owners = {}
+        for name, target in targets.items():
+            for source in target['sources']:
+                self._owners.setdefault(source, []).append(name)
+
+    def owners(self, path):
+        """Names of the targets that have ``path`` among their sources"""
+        return self._owners.get(normpath(path), [])
+
+    def dependents(self, names):
+        """``names`` and the names of all the targets that depend on them, directly or not"""
+        reverse = {}
+        for name, target in self.targets.items():
+            for dependency in target['dependencies']:
+                reverse.setdefault(dependency, set()).add(name)
+        result, stack = set(), list(names)
+        while stack:
+            name = stack.pop()
+            if name not in result:
+                result.add(name)
+                stack.extend(reverse.get(name, ()))
+        return result
+
+
+def _absolute(base, path):
+    return normpath(path if isabs(path) else join(base, path))
+
+
+def reply_index(build_directory):
+    """Path of the latest reply index of the file API in ``build_directory``, None if CMake did not write any"""
+    reply = join(build_directory, api_directory, 'reply')
+    try:
+        indexes = sorted(name for name in os.listdir(reply) if name.startswith('index-') and name.endswith('.json'))
+    except FileNotFoundError:
+        return None
+    return join(reply, indexes[-1]) if indexes else None
+
+
+def _reply_object(build_directory, kind):
+    """Returns the reply directory of the file API in ``build_directory`` and its reply object of ``kind``,
+    (None, None) if CMake did not write any"""
+    index_path = reply_index(build_directory)
+    if index_path is None:
+        return None, None
+    reply = os.path.dirname(index_path)
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    json_file = None
+    for obj in index.get('objects', []):
+        if obj.get('kind', None) == kind:
+            json_file = obj['jsonFile']
+    if json_file is None:
+        return None, None
+    with open(join(reply, json_file), 'r') as f:
+        return reply, json.load(f)
+
+
+def load_inputs(build_directory):
+    """Absolute paths of the files CMake read to generate the build system of ``build_directory`` (CMakeLists.txt,
+    included scripts, configure_file() inputs...) except the generated ones, None if the file API did not list them"""
+    _, cmake_files_object = _reply_object(build_directory, 'cmakeFiles')
+    if cmake_files_object is None:
+        return None
+    source_directory = cmake_files_object['paths']['source']
+    return sorted(_absolute(source_directory, entry['path']) for entry in cmake_files_object.get('inputs', [])
+                  if not entry.get('isGenerated', False))
+
+
+def load(build_directory, configuration=None):
+    """Reads the codemodel written by CMake in ``build_directory``, returns None if there is none"""
+    reply, codemodel = _reply_object(build_directory, 'codemodel')
+    if codemodel is None:
+        return None
+    source_directory = codemodel['paths']['source']
+    configurations = codemodel['configurations']
+    selected = next((c for c in configurations if c['name'] == configuration), configurations[0])
+    ids = {}
+    targets = {}
+    for entry in selected['targets']:
+        with open(join(reply, entry['jsonFile']), 'r') as f:
+            target = json.load(f)
+        ids[target['id']] = target['name']
+        targets[target['name']] = {
+            'type': target['type'],
+            'sources': [_absolute(source_directory, source['path']) for source in target.get('sources', [])],
+            'artifacts': [_absolute(build_directory, artifact['path']) for artifact in target.get('artifacts', [])],
+            'dependencies': [dependency['id'] for dependency in target.get('dependencies', [])],
+        }
+    for target in targets.values():
+        target['dependencies'] = [ids[dependency] for dependency in target['dependencies'] if dependency in ids]
+    return CodeModel(source_directory, build_directory, targets)
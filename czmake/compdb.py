@@ -0,0 +1,89 @@
+import json
+import os
+import shlex
+from os.path import join, isabs, normpath, relpath, exists
+
+compile_commands_file = 'compile_commands.json'
+index_file = 'czmake_compdb_index.json'
+
+
+def _output(entry):
+    if 'output' in entry:
+        return entry['output']
+    args = entry['arguments'] if 'arguments' in entry else shlex.split(entry['command'])
+    for i, arg in enumerate(args):
+        if arg == '-o' and i + 1 < len(args):
+            return args[i + 1]
+        elif arg.startswith(('/Fo', '-Fo')):
+            return arg[3:]
+    return None
+
+
+def build_index(build_directory):
+    """Maps the absolute path of each source file in compile_commands.json to the path of its object files,
+    relative to ``build_directory``"""
+    with open(join(build_directory, compile_commands_file), 'r') as f:
+        entries = json.load(f)
+    index = {}
+    for entry in entries:
+        output = _output(entry)
+        if output is None:
+            continue
+        directory = entry.get('directory', build_directory)
+        source = entry['file'] if isabs(entry['file']) else join(directory, entry['file'])
+        if isabs(output):
+            output = relpath(output, build_directory)
+        else:
+            output = relpath(join(directory, output), build_directory)
+        index.setdefault(normpath(source), []).append(output)
+    return index
+
+
+def load_index(build_directory):
+    """Returns the source to objects index, parsing compile_commands.json only when it changed since the index was
+    cached in the build directory. Returns None if there is no compile_commands.json"""
+    try:
+        st = os.stat(join(build_directory, compile_commands_file))
+    except FileNotFoundError:
+        return None
+    stamp = [st.st_mtime_ns, st.st_size]
+    cached = join(build_directory, index_file)
+    try:
+        with open(cached, 'r') as f:
+            data = json.load(f)
+        if data['stamp'] == stamp:
+            return data['index']
+    except (OSError, ValueError, KeyError):
+        pass
+    index = build_index(build_directory)
+    tmp = '%s.%d.tmp' % (cached, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'stamp': stamp, 'index': index}, f)
+    os.replace(tmp, cached)
+    return index
+
+
+def objects(build_directory, source):
+    index = load_index(build_directory)
+    if index is None:
+        return None
+    return index.get(normpath(os.path.abspath(source)), [])
+
+
+def object_target(build_directory, obj):
+    """Returns the name of the CMake target an object file belongs to (from its CMakeFiles/<target>.dir
+    directory) and the path of the directory relative to ``build_directory``"""
+    parts = obj.replace('\\', '/').split('/')
+    for i, part in enumerate(parts):
+        if part.endswith('.dir') and i > 0 and parts[i - 1] == 'CMakeFiles':
+            return part[:-4], '/'.join(parts[:i + 1])
+    return None, None
+
+
+def make_command(build_directory, obj, make_program='make'):
+    """Command line that builds only the object file ``obj`` with the Makefiles of a Makefile generator
+    (Ninja does not need one as object files are targets of their own)"""
+    target, target_directory = object_target(build_directory, obj)
+    if target is None or not exists(join(build_directory, target_directory, 'build.make')):
+        return None
+    return [make_program, '-C', build_directory, '-f', '%s/build.make' % target_directory, obj]
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+from os.path import join, expanduser, basename, isabs
+
+from .utils import echo
+from .report import object_suffixes
+
+logger = logging.getLogger(__name__)
+
+tools = ('ccache', 'sccache')
+cache_root = os.environ.get('CZMAKE_COMPILER_CACHE', join(expanduser('~'), '.cache', 'czmake', 'compiler-cache'))
+launcher_options = ('CMAKE_C_COMPILER_LAUNCHER', 'CMAKE_CXX_COMPILER_LAUNCHER')
+
+ccache_hits = ('direct_cache_hit', 'preprocessed_cache_hit', 'remote_storage_hit')
+ccache_misses = ('cache_miss',)
+ccache_ignored = ('stats_updated_timestamp', 'stats_zeroed_timestamp', 'cache_size_kibibyte', 'files_in_cache',
+                  'cleanups_performed', 'direct_cache_miss', 'preprocessed_cache_miss', 'local_storage_hit',
+                  'local_storage_miss', 'local_storage_read_hit', 'local_storage_read_miss', 'local_storage_write',
+                  'remote_storage_miss', 'remote_storage_read_hit', 'remote_storage_read_miss',
+                  'remote_storage_write', 'called_for_link', 'called_for_preprocessing')
+
+
+def settings(cfg):
+    """Returns the compiler cache settings of a configuration as a dict with 'tool', 'directory' and 'max_size',
+    or None if no compiler cache is used. In build.czmake "compiler_cache" can be either the tool name or such a dict"""
+    value = cfg.get('compiler_cache', None)
+    if value is None:
+        # configurations written before "compiler_cache" existed set the launcher themselves
+        launcher = cfg.get('options', {}).get('CMAKE_CXX_COMPILER_LAUNCHER', None)
+        value = launcher if launcher in tools else None
+    if not value:
+        return None
+    result = {'tool': value} if isinstance(value, str) else dict(value)
+    result.setdefault('tool', 'ccache')
+    if result['tool'] not in tools:
+        raise ValueError('Unsupported compiler cache "%s", expected one of %s' % (result['tool'], ', '.join(tools)))
+    if not result.get('directory', None):
+        import hashlib
+        project = cfg.get('project_directory', None) or cfg['source_directory']
+        result['directory'] = join(cache_root, result['tool'], '%s-%s' % (
+            basename(project), hashlib.md5(project.encode()).hexdigest()[:8]))
+    elif not isabs(result['directory']) and cfg.get('project_directory', None):
+        result['directory'] = join(cfg['project_directory'], result['directory'])
+    return result
+
+
+def options(cfg):
+    cache = settings(cfg)
+    if cache is None:
+        # a cache disabled with --ccache false has to be removed from an existing CMake cache as well
+        return {option: '' for option in launcher_options} if cfg.get('compiler_cache', None) is False else {}
+    return {option: cache['tool'] for option in launcher_options}
+
+
+def environment(cfg):
+    cache = settings(cfg)
+    if cache is None:
+        return {}
+    if cache['tool'] == 'ccache':
+        env = {'CCACHE_DIR': cache['directory']}
+        if cfg.get('project_directory', None):
+            # lets builds from different build directories (and workspaces with the same layout) share results
+            env['CCACHE_BASEDIR'] = cfg['project_directory']
+        if cache.get('max_size', None):
+            env['CCACHE_MAXSIZE'] = str(cache['max_size'])
+    else:
+        env = {'SCCACHE_DIR': cache['directory']}
+        if cache.get('max_size', None):
+            env['SCCACHE_CACHE_SIZE'] = str(cache['max_size'])
+    return env
+
+
+def stats(cfg, env):
+    """Returns a snapshot of the counters of the compiler cache as a flat dict, None if unavailable"""
+    cache = settings(cfg)
+    if cache is None:
+        return None
+    import subprocess
+    try:
+        if cache['tool'] == 'ccache':
+            output = subprocess.check_output(['ccache', '--print-stats'], env=env, stderr=subprocess.DEVNULL)
+            result = {}
+            for line in output.decode(errors='replace').splitlines():
+                key, _, value = line.partition('\t')
+                if value.strip().isdigit() and key not in ccache_ignored:
+                    result[key] = int(value)
+            return result
+        else:
+            output = subprocess.check_output(['sccache', '--show-stats', '--stats-format=json'], env=env,
+                                             stderr=subprocess.DEVNULL)
+            data = json.loads(output.decode()).get('stats', {})
+            result = {
+                'cache_hit': sum(data.get('cache_hits', {}).get('counts', {}).values()),
+                'cache_miss': sum(data.get('cache_misses', {}).get('counts', {}).values()),
+            }
+            for reason, count in data.get('not_cached', {}).items():
+                result['not_cached: %s' % reason] = count
+            for key in ('compile_fails', 'forced_recaches', 'cache_errors', 'non_cacheable_compilations'):
+                value = data.get(key, 0)
+                result[key] = sum(value.get('counts', {}).values()) if isinstance(value, dict) else value
+            return result
+    except (OSError, subprocess.CalledProcessError, ValueError) as err:
+        logger.warning('Unable to read the %s statistics: %s' % (cache['tool'], err))
+        return None
+
+
+def summarize(cfg, before, after, stages, prefix=None):
+    """Prints hits, misses (by reason) and the estimated time saved between two stats() snapshots,
+    ``stages`` are the build stages whose Ninja edges give the compile times"""
+    if before is None or after is None:
+        return
+    delta = {key: after.get(key, 0) - before.get(key, 0) for key in after}
+    hits = sum(delta.pop(key, 0) for key in ccache_hits + ('cache_hit',))
+    misses = sum(delta.pop(key, 0) for key in ccache_misses)
+    reasons = sorted(((count, key) for key, count in delta.items() if count > 0), reverse=True)
+    calls = hits + misses
+    if not calls and not reasons:
+        return
+    compile_times = [(end_ms - start_ms) / 1000.0 for s in stages for start_ms, end_ms, output in s.get('edges', [])
+                     if output.endswith(object_suffixes)]
+    message = '-- %s: %d hits, %d misses (%.1f%% hit rate)' % (
+        settings(cfg)['tool'], hits, misses, 100.0 * hits / calls if calls else 0)
+    if compile_times and hits:
+        # cached compilations are almost free, so the misses give an idea of the time a hit saves
+        slowest = sorted(compile_times)[-max(1, misses):]
+        message += ', about %.1f s saved' % (hits * sum(slowest) / len(slowest))
+    echo(message, prefix)
+    for count, reason in reasons:
+        echo('--   %s: %d' % (reason, count), prefix)
+    if calls >= 20 and hits < 0.1 * calls and not reasons:
+        logger.warning('Compiler cache hit rate is very low, check the options reported by "czconfigure --show" '
+                       'for absolute paths or values that change at every build')
+
+
+def check_options(cfg, prefix=None):
+    """Warns about configuration options that are known to defeat the compiler cache"""
+    cache = settings(cfg)
+    if cache is None:
+        return
+    import re
+    base = cfg.get('project_directory', None)
+    for key, value in cfg.get('options', {}).items():
+        if not isinstance(value, str) or 'FLAGS' not in key:
+            continue
+        for flag in value.split():
+            path = re.sub(r'^(-[IiLD]|-include|-isystem|/I|-[a-z-]+=)', '', flag)
+            if isabs(path) and cache['tool'] == 'ccache' and not (base and path.startswith(base)):
+                logger.warning('%s contains the absolute path "%s" outside of the project directory, '
+                               'the compiler cache will not be shared between workspaces' % (key, path))
+            elif '__DATE__' in flag or '__TIME__' in flag or '__TIMESTAMP__' in flag:
+                logger.warning('%s uses "%s", its value changes at every build and ruins the compiler cache '
+                               'hit rate' % (key, flag))
+            elif cache['tool'] == 'sccache' and flag in ('/Zi', '-Zi'):
+                logger.warning('%s contains "%s", sccache cannot cache compilations writing PDB files, use /Z7'
+                               % (key, flag))
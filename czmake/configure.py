@@ -3,13 +3,22 @@ import json
 import os
 import sys
 import logging
-import platform
-from multiprocessing import cpu_count
-from os.path import dirname, abspath, join, exists, basename
-from shutil import rmtree
-from .utils import DirectoryContext, mkdir, str2bool, cmake_exe, parse_option, dump_option, fork, update_dict, \
-    cache_file
-from .build import build
+import time
+from copy import deepcopy
+from importlib.util import find_spec
+from os.path import dirname, abspath, join, exists
+from .utils import mkdir, str2bool, cmake_exe, parse_option, dump_option, fork, update_dict, cache_file, \
+    fingerprint_file, cmake_version, echo
+from .build import build, test_stage, add_report_arguments, add_postprocess_arguments, add_affected_arguments, \
+    sequential_targets
+from .output import Session, add_output_arguments
+from .testing import add_test_arguments
+from .packaging import add_package_arguments
+from .prebuilt import add_prebuilt_arguments
+from .probes import add_probe_arguments
+from . import report
+from .cmake_cache import load_cache
+from . import jobs, codemodel, compiler_cache, distribute, cleanup, prebuilt, probes
 
 logger = logging.getLogger(__name__)
 
@@ -31,8 +40,7 @@ def argv_parse():
     parser.add_argument("-E", "--cmake-exe", help="use specified cmake executable", metavar='CMAKE_EXE')
     parser.add_argument("-G", "--generator", metavar="CMAKE_GENERATOR",
                         help="Specify CMake generator (e.g. 'CodeLite - Unix Makefiles')")
-    parser.add_argument("-j", "--jobs", metavar="JOBS", type=int,
-                        help="maximum number of concurrent jobs (only works if native build system has support for '-j N' command line parameter)")
+    jobs.add_job_arguments(parser)
     parser.add_argument("-T", "--cmake-target", nargs='*', help="build specified cmake target(s)")
     parser.add_argument("-f", "--configuration-file", default=join(os.getcwd(), 'build.czmake'),
                         help="load build configuration from CONFIGURATION_FILE, default is 'czmake_build.json'",
@@ -40,6 +48,19 @@ def argv_parse():
     parser.add_argument("-C", "--clean", type=str2bool, nargs='?', const=True,
                         help="choose whether or not delete the build directory at the beginning of the build",
                         metavar='(true|false)')
+    parser.add_argument("--force-configure", action='store_true',
+                        help="run CMake even if nothing that affects the configure step has changed")
+    parser.add_argument("--profile", action='store_true',
+                        help="profile the CMake configure step (requires CMake 3.18), the result is included in the "
+                             "trace exported with --trace")
+    add_postprocess_arguments(parser)
+    add_report_arguments(parser)
+    add_output_arguments(parser)
+    add_test_arguments(parser)
+    add_package_arguments(parser)
+    add_affected_arguments(parser)
+    add_prebuilt_arguments(parser)
+    add_probe_arguments(parser)
     parser.add_argument("--lto", type=str2bool, nargs='?', const=True, metavar='(true|false)',
                         help="Enable link-time optimization support")
     parser.add_argument("-l", "--list", help="list build configurations", action='store_true')
@@ -51,177 +72,458 @@ def argv_parse():
                         metavar='DIR')
     parser.add_argument("--build", action='store_true', help="Start the build process after configuration is finished")
     parser.add_argument("-c", "--configuration-name", nargs='*', help="name of the build configuration to use")
+    parser.add_argument("--matrix", action='store_true',
+                        help="resolve each configuration passed with -c on its own and configure (and build) all of "
+                             "them concurrently, sharing the job budget given by -j")
+    parser.add_argument("--autotune", nargs='?', type=int, const=0, metavar='MAX_VARIANTS',
+                        help="build the variants declared in the \"autotune\" entry of the configuration, each in its "
+                             "own build directory, and save the fastest one as a new configuration inheriting from it "
+                             "(at most MAX_VARIANTS new builds, default 16)")
     parser.add_argument("--ccache", type=str2bool, nargs='?', const=True, metavar='(true|false)', help="Use ccache")
+    parser.add_argument("--compiler-cache", choices=compiler_cache.tools + ('none',),
+                        help="compiler cache used as compiler launcher (\"compiler_cache\" in build.czmake)")
+    parser.add_argument("--compiler-cache-directory", metavar='DIR',
+                        help="directory of the compiler cache, default is a directory of the project under "
+                             "~/.cache/czmake/compiler-cache (CZMAKE_COMPILER_CACHE)")
+    parser.add_argument("--compiler-cache-size", metavar='SIZE', help="size limit of the compiler cache (e.g. 20G)")
+    parser.add_argument("--distribute", choices=('distcc', 'icecc', 'none'),
+                        help="distribute the compilations with distcc or icecream (chained after the compiler cache "
+                             "if any), the default number of jobs becomes the number of remote slots")
+    parser.add_argument("--distribute-hosts", metavar='HOSTS',
+                        help="with --distribute distcc, the hosts to use in the DISTCC_HOSTS format "
+                             "(e.g. '127.0.0.1/8' to test against a local distccd)")
+    parser.add_argument("--warm-compiler-cache", action='store_true',
+                        help="build the configuration in a scratch directory only to fill the compiler cache shared "
+                             "by the other build directories of the project (e.g. nightly, with the release one)")
     parser.add_argument("extra_args", nargs='*', help="extra arguments to pass to CMake or native build system")
-    try: 
-        import quark
+    # only check that quark is installed, importing it is expensive and it is not needed unless -u is given
+    if find_spec('quark') is not None:
         parser.add_argument("-u", "--update", help="update dependencies using quark", action="store_true")
-    except ImportError:
-        pass
+        parser.add_argument("--fetch-jobs", type=int, metavar='N',
+                            help="with -u, number of git externals fetched concurrently (default 4)")
+        parser.add_argument("--mirror-directory", metavar='DIR',
+                            help="with -u, directory holding the local mirrors of the git externals shared by all "
+                                 "the workspaces (default ~/.cache/czmake/mirrors, CZMAKE_MIRRORS)")
     args = parser.parse_args()
     return args
 
 
-def parse_cfg(default_configuration=None):
-    args = argv_parse()
-    project_directory = args.project_directory or dirname(abspath(args.configuration_file)) if exists(
-        args.configuration_file) else abspath('.')
-    bdirname = 'build-%s' % basename(project_directory)
+def inheritance_chain(build_cfg, configuration_names, configuration_file=None):
     configuration_list = []
-    try:
-        build_cfg = json.load(open(args.configuration_file, 'r'))
-        if args.list:
-            for cfg in sorted(build_cfg['configurations'].keys()):
-                print(cfg)
-            sys.exit(0)
-
-        if not args.configuration_name:
-            args.configuration_name = default_configuration or build_cfg['default']
-        if isinstance(args.configuration_name, str):
-            args.configuration_name = [args.configuration_name]
-        configuration_set = set()
-        for configuration in args.configuration_name:
-            if configuration not in build_cfg['configurations']:
-                raise KeyError('Configuration "%s" does not exist in configuration provided by "%s"' %
-                               (args.configuration_name, args.configuration_file))
-            inheritance_list = [configuration]
-            inheritance_set = set(inheritance_list)
-            configuration_inheritance_set = set()
-            while True:
-                cfg_key = inheritance_list[-1]
-                parent = build_cfg['configurations'][cfg_key].get('inherits', None)
-                if parent:
-                    if parent in configuration_inheritance_set:
-                        raise ValueError('Inheritance loop detected with build configuration "%s"' % parent)
-                    else:
-                        configuration_inheritance_set.add(parent)
-                    inheritance_list.append(parent)
-                    inheritance_set.add(parent)
+    configuration_set = set()
+    for configuration in configuration_names:
+        if configuration not in build_cfg['configurations']:
+            raise KeyError('Configuration "%s" does not exist in configuration provided by "%s"' %
+                           (configuration, configuration_file))
+        inheritance_list = [configuration]
+        configuration_inheritance_set = set()
+        while True:
+            cfg_key = inheritance_list[-1]
+            parent = build_cfg['configurations'][cfg_key].get('inherits', None)
+            if parent:
+                if parent in configuration_inheritance_set:
+                    raise ValueError('Inheritance loop detected with build configuration "%s"' % parent)
                 else:
-                    break
-            for conf in reversed(inheritance_list):
-                if conf not in configuration_set:
-                    configuration_set.add(conf)
-                    configuration_list.append(conf)
-        for conf in args.configuration_name:
-            bdirname += '-' + conf
-    except FileNotFoundError as err:
-        if args.configuration_name:
-            raise err
-        else:
-            build_cfg = {}
-            logger.warning('Build configuration file "%s" not found' % join(args.configuration_file))
+                    configuration_inheritance_set.add(parent)
+                inheritance_list.append(parent)
+            else:
+                break
+        for conf in reversed(inheritance_list):
+            if conf not in configuration_set:
+                configuration_set.add(conf)
+                configuration_list.append(conf)
+    return configuration_list
 
-    cfg = {
+
+def base_cfg():
+    return {
         'source_directory': '.',
-        'build_directory': bdirname,
+        'build_directory': None,
         'clean': False,
         'cmake_exe': cmake_exe,
         'cmake_target': None,
         'options': {
         },
     }
-    with DirectoryContext(project_directory):
-        if 'source_directory' in build_cfg:
-            build_cfg['source_directory'] = abspath(build_cfg['source_directory'])
-        if 'build_directory' in build_cfg:
-            build_cfg['build_directory'] = abspath(build_cfg['build_directory'])
-
-    for conf in configuration_list:
-        update_dict(cfg, build_cfg['configurations'][conf])
-
-    with DirectoryContext(project_directory):
-        cfg['source_directory'] = abspath(cfg['source_directory'])
-        cfg['build_directory'] = abspath(cfg['build_directory'])
-
-    if args.toolchain_file:
-        cfg['options']['CMAKE_TOOLCHAIN_FILE'] = args.toolchain_file
-    if args.build_type:
-        cfg['options']['CMAKE_BUILD_TYPE'] = args.build_type
-    if args.ccache is not None:
-        cfg['options']['CMAKE_C_COMPILER_LAUNCHER'] = 'ccache'
-        cfg['options']['CMAKE_CXX_COMPILER_LAUNCHER'] = 'ccache'
-    if args.lto is not None:
-        cfg['options']['CMAKE_INTERPROCEDURAL_OPTIMIZATION'] = True
-    if args.clean is not None:
-        cfg['clean'] = args.clean
-    if args.build_directory:
-        cfg['build_directory'] = args.build_directory
-    if args.source_directory:
-        cfg['source_directory'] = args.source_directory
-    if args.generator:
-        cfg['generator'] = args.generator
-    if args.cmake_exe:
-        cfg['cmake_exe'] = args.cmake_exe
-    if not args.cmake_target is None:
-        cfg['cmake_target'] = args.cmake_target
+
+
+def merge_configurations(build_cfg, configuration_list, memo=None):
+    """Merges the configurations of ``configuration_list`` (an inheritance chain) on top of the defaults,
+    ``memo`` is a dict caching the result for every prefix of the chains, which are shared by configurations
+    with common ancestors"""
+    key = tuple(configuration_list)
+    if memo is not None and key in memo:
+        return deepcopy(memo[key])
+    if key:
+        cfg = merge_configurations(build_cfg, key[:-1], memo)
+        update_dict(cfg, deepcopy(build_cfg['configurations'][key[-1]]))
+    else:
+        cfg = base_cfg()
+    if memo is not None:
+        memo[key] = deepcopy(cfg)
+    return cfg
+
+
+def resolve_cfg(arguments, build_cfg, configuration_list, project_directory, bdirname, memo=None):
+    """Returns the configuration resulting from ``configuration_list`` with the command line ``arguments``
+    (a dict with the destinations of the czconfigure options, missing ones count as not given) applied on top"""
+    cfg = merge_configurations(build_cfg, configuration_list, memo)
+    if not cfg['build_directory']:
+        cfg['build_directory'] = bdirname
+    cfg['source_directory'] = abspath(join(project_directory, cfg['source_directory']))
+    cfg['build_directory'] = abspath(join(project_directory, cfg['build_directory']))
+
+    def arg(key):
+        return arguments.get(key, None)
+
+    if arg('toolchain_file'):
+        cfg['options']['CMAKE_TOOLCHAIN_FILE'] = arg('toolchain_file')
+    if arg('build_type'):
+        cfg['options']['CMAKE_BUILD_TYPE'] = arg('build_type')
+    if arg('ccache') is not None:
+        cfg['compiler_cache'] = 'ccache' if arg('ccache') else False
+    if arg('compiler_cache') is not None:
+        cfg['compiler_cache'] = arg('compiler_cache') if arg('compiler_cache') != 'none' else False
+    if arg('compiler_cache_directory') or arg('compiler_cache_size'):
+        cache = cfg.get('compiler_cache', None)
+        cache = dict(cache) if isinstance(cache, dict) else {'tool': cache or 'ccache'}
+        if arg('compiler_cache_directory'):
+            cache['directory'] = abspath(arg('compiler_cache_directory'))
+        if arg('compiler_cache_size'):
+            cache['max_size'] = arg('compiler_cache_size')
+        cfg['compiler_cache'] = cache
+    if cfg.get('compiler_cache', None) is False:
+        for option in compiler_cache.launcher_options:
+            if cfg['options'].get(option, None) in compiler_cache.tools:
+                del cfg['options'][option]
+    if arg('distribute') is not None:
+        cfg['distribute'] = arg('distribute') if arg('distribute') != 'none' else False
+    if arg('distribute_hosts'):
+        dist = cfg.get('distribute', None)
+        dist = dict(dist) if isinstance(dist, dict) else {'tool': dist or 'distcc'}
+        dist['hosts'] = arg('distribute_hosts')
+        cfg['distribute'] = dist
+    if arg('prebuilt') is not None:
+        value = arg('prebuilt')
+        cfg['prebuilt'] = False if value == 'none' else True if value == 'all' else value.split(',')
+    if arg('prebuilt_cache_size'):
+        spec = cfg.get('prebuilt', None)
+        spec = dict(spec) if isinstance(spec, dict) else {'modules': spec if isinstance(spec, list) else 'all'}
+        spec['max_size'] = arg('prebuilt_cache_size')
+        cfg['prebuilt'] = spec
+    if arg('lto') is not None:
+        cfg['options']['CMAKE_INTERPROCEDURAL_OPTIMIZATION'] = arg('lto')
+    if arg('clean') is not None:
+        cfg['clean'] = arg('clean')
+    if arg('build_directory'):
+        cfg['build_directory'] = arg('build_directory')
+    if arg('source_directory'):
+        cfg['source_directory'] = arg('source_directory')
+    if arg('generator'):
+        cfg['generator'] = arg('generator')
+    if arg('cmake_exe'):
+        cfg['cmake_exe'] = arg('cmake_exe')
+    if arg('cmake_target') is not None:
+        cfg['cmake_target'] = arg('cmake_target')
     if isinstance(cfg['cmake_target'], str):
         cfg['cmake_target'] = [cfg['cmake_target']]
-    if args.package:
-        cfg['cmake_target'] = cfg.get('cmake_target', []) + ['package']
-    elif args.package == False and cfg['cmake_target']:
+    if arg('package'):
+        cfg['cmake_target'] = (cfg.get('cmake_target', None) or []) + ['package']
+    elif arg('package') == False and cfg['cmake_target']:
         cfg['cmake_target'] = [target for target in cfg['cmake_target'] if target != 'package']
-    if args.install:
-        cfg['cmake_target'] = cfg.get('cmake_target', []) + ['install']
-    elif args.install == False and cfg['cmake_target']:
+    if arg('install'):
+        cfg['cmake_target'] = (cfg.get('cmake_target', None) or []) + ['install']
+    elif arg('install') == False and cfg['cmake_target']:
         cfg['cmake_target'] = [target for target in cfg['cmake_target'] if target != 'install']
-    cfg['extra_args'] = args.extra_args
-    cfg['jobs'] = args.jobs
-    cfg['build'] = args.build
-    cfg['launch_ccmake'] = args.launch_ccmake
+    if arg('package_generators'):
+        cfg['package_generators'] = arg('package_generators').split(',')
+    cfg['extra_args'] = arg('extra_args') or []
+    for key in ('jobs', 'load_average', 'mem_per_job', 'link_jobs', 'mem_per_link_job', 'strip', 'upx', 'upx_cache',
+                'fetch_jobs', 'mirror_directory'):
+        if arg(key) is not None:
+            cfg[key] = arg(key)
+    for key in ('build', 'launch_ccmake', 'force_configure', 'profile'):
+        cfg[key] = bool(arg(key))
+    cfg['report'] = arg('report')
+    cfg['trace'] = arg('trace')
+    cfg['output'] = arg('output')
+    cfg['test'] = bool(arg('test'))
+    cfg['shard'] = arg('shard')
+    cfg['affected_since'] = arg('affected_since')
+    cfg['warm_compiler_cache'] = bool(arg('warm_compiler_cache'))
+    cfg['probe_cache_action'] = arg('probe_cache')
 
-    if args.options:
-        for option in args.options:
+    options = arg('options')
+    if isinstance(options, dict):
+        cfg['options'].update(options)
+    elif options:
+        for option in options:
             key, value = parse_option(option)
             cfg['options'][key] = value
     cfg['project_directory'] = project_directory
+    return cfg
+
+
+def parse_cfg(default_configuration=None):
+    from .api import BuildFile
+    args = argv_parse()
+    project_directory = args.project_directory or dirname(abspath(args.configuration_file)) if exists(
+        args.configuration_file) else abspath('.')
+    try:
+        build_file = BuildFile.load(args.configuration_file, project_directory)
+    except FileNotFoundError as err:
+        if args.configuration_name:
+            raise err
+        build_file = BuildFile({}, project_directory)
+        logger.warning('Build configuration file "%s" not found' % join(args.configuration_file))
+    if args.list:
+        for name in build_file.configurations:
+            print(name)
+        sys.exit(0)
+    names = args.configuration_name or default_configuration or build_file.default
+    if isinstance(names, str):
+        names = [names]
+    arguments = vars(args)
+
+    kwargs = {'update': arguments.get('update', False)}
+    if args.autotune is not None:
+        if args.matrix or len(names or []) != 1:
+            raise ValueError('--autotune requires exactly one build configuration')
+        kwargs['autotune'] = {'configuration_file': abspath(args.configuration_file), 'max_variants': args.autotune}
+    if args.matrix and build_file.data:
+        if args.build_directory:
+            raise ValueError('--build-directory cannot be used together with --matrix')
+        if args.warm_compiler_cache or args.probe_cache:
+            raise ValueError('--%s cannot be used together with --matrix' % (
+                'warm-compiler-cache' if args.warm_compiler_cache else 'probe-cache'))
+        cfg = build_file.resolve_matrix(names, **arguments)
+        kwargs['matrix'] = True
+    else:
+        cfg = build_file.resolve(names, **arguments)
+    if args.history:
+        for configuration in (cfg.values() if kwargs.get('matrix', False) else [cfg]):
+            report.print_history(configuration, args.history)
+        sys.exit(0)
     if args.show:
         print(json.dumps(cfg, indent=4))
         sys.exit(0)
     else:
-        args_dict = vars(args)
-        return args.configuration_name, cfg, {'update' : args_dict.get('update', False)}
+        return names, cfg, kwargs
 
 
-def configure(configuration, update=False):
-    if update:
-        import quark
-        quark.checkout.resolve_dependencies(configuration['source_directory'], options=configuration['options'])
-    cfg = configuration
-    env = os.environ
-    if platform.system() != 'Windows' and 'MAKEFLAGS' not in os.environ:
-        env['MAKEFLAGS'] = "-j%d" % cpu_count()
-    if cfg['clean']:
-        exists(cfg['build_directory']) and rmtree(cfg['build_directory'])
-    mkdir(cfg['build_directory'])
-    cmd = [cfg['cmake_exe'], '-DCMAKE_MODULE_PATH:PATH=%s' % join(dirname(__file__), 'cmake')]
+# environment variables that are read by CMake during the configure step
+fingerprint_env = ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'ASM', 'ASMFLAGS', 'RC', 'RCFLAGS',
+                   'CMAKE_PREFIX_PATH', 'CMAKE_GENERATOR', 'CMAKE_TOOLCHAIN_FILE', 'PKG_CONFIG_PATH']
+
+
+def configure_fingerprint(cfg, cmd, env):
+    import hashlib
+    md5 = hashlib.md5()
+    md5.update(json.dumps(cmd).encode())
+    md5.update(repr(cfg.get('generator', None)).encode())
+    md5.update(repr(cmake_version(cfg['cmake_exe'])).encode())
+    for key in fingerprint_env:
+        md5.update(('%s=%s\n' % (key, env.get(key, ''))).encode())
+    toolchain_file = cfg['options'].get('CMAKE_TOOLCHAIN_FILE', None)
+    if toolchain_file:
+        try:
+            with open(join(cfg['build_directory'], toolchain_file), 'rb') as f:
+                md5.update(f.read())
+        except OSError:
+            pass
+    return md5.hexdigest()
+
+
+def update_dependencies(cfg, prefix=None):
+    import quark
+    from . import externals
+    start = time.time()
+    mirrors = externals.fetch(cfg['source_directory'], cfg['options'], cfg.get('fetch_jobs', None),
+                              cfg.get('mirror_directory', None), prefix)
+    mirrored = len([mirror for mirror in mirrors.values() if mirror])
+    if mirrored:
+        echo('-- Mirrored %d externals in %.2f s' % (mirrored, time.time() - start), prefix)
+    with externals.using_mirrors(mirrors):
+        quark.checkout.resolve_dependencies(cfg['source_directory'], options=cfg['options'])
+
+
+def cmake_options(cfg):
+    # compile_commands.json is needed by czmake --file
+    options = {'CMAKE_MODULE_PATH:PATH': join(dirname(__file__), 'cmake'), 'CMAKE_EXPORT_COMPILE_COMMANDS': True}
+    options.update(jobs.job_pool_options(cfg))
+    options.update(compiler_cache.options(cfg))
+    options.update(distribute.options(cfg))
+    options.update(cfg['options'])
+    options.update(prebuilt.options(cfg))
+    return options
+
+
+def configure_command(cfg, options=None):
+    cmd = [cfg['cmake_exe']]
     if 'generator' in cfg:
         cmd += ['-G', '%s' % (cfg['generator'])]
-    for key, value in cfg["options"].items():
+    for key, value in (cmake_options(cfg) if options is None else options).items():
         cmd.append(dump_option(key, value))
-    if cfg['build'] and 'extra_args' in cfg:
+    if cfg['build'] and cfg.get('extra_args', None):
         cmd += cfg['extra_args']
+    cmd.append(abspath(cfg['source_directory']))
+    return cmd
+
+
+def configure(configuration, update=False, prefix=None):
+    if update:
+        update_dependencies(configuration)
+    cfg = configuration
+    env = jobs.build_env(cfg)
+    if cfg['clean'] and exists(cfg['build_directory']):
+        cleanup.remove_async(cfg['build_directory'])
+    mkdir(cfg['build_directory'])
+    cleanup.mark_used(cfg['build_directory'])
     cfg['source_directory'] = abspath(cfg['source_directory'])
-    cmd.append(cfg['source_directory'])
+    fresh = not exists(join(cfg['build_directory'], 'CMakeCache.txt'))
+    stages = []
+    if prebuilt.settings(cfg) is not None:
+        start = time.time()
+        cfg['prebuilt_prefixes'] = prebuilt.prepare(cfg, prefix)
+        stages.append(report.stage('prebuilt', start, modules=len(cfg['prebuilt_prefixes'])))
+    cmd = configure_command(cfg)
+
+    fingerprint = configure_fingerprint(cfg, cmd, env)
+    fpfile = join(cfg['build_directory'], fingerprint_file)
+    cache = None if cfg.get('force_configure', False) else load_cache(cfg['build_directory'])
+    if codemodel.request(cfg['build_directory']):
+        up_to_date = False
+    elif cache is not None:
+        try:
+            with open(fpfile, 'r') as f:
+                up_to_date = f.read() == fingerprint
+        except FileNotFoundError:
+            up_to_date = False
+    else:
+        up_to_date = False
+    if up_to_date:
+        echo('-- Configuration is up to date, skipping CMake (use --force-configure to override)', prefix)
+    else:
+        compiler_cache.check_options(cfg)
+        if cache is not None:
+            # the existing cache already holds the other options, only send the ones that changed
+            cmd = configure_command(cfg, cache.diff(cmake_options(cfg)))
+        elif fresh and probes.enabled(cfg):
+            seed = probes.seed(cfg, prefix)
+            if seed is not None:
+                echo('-- Seeding the compiler and check results of the toolchain from the probe cache', prefix)
+                cmd[1:1] = ['-C', seed]
+        profile = None
+        if cfg.get('profile', False):
+            if cmake_version(cfg['cmake_exe']) >= (3, 18):
+                profile = join(cfg['build_directory'], report.profile_file)
+                cmd[1:1] = ['--profiling-format=google-trace', '--profiling-output=%s' % profile]
+            else:
+                logger.warning('CMake profiling requires CMake 3.18 or newer')
+        exists(fpfile) and os.remove(fpfile)
+        start = time.time()
+        with Session(cfg['build_directory'], 'configure', cfg.get('output', None), prefix) as output:
+            fork(cmd, prefix=prefix, output=output, cwd=cfg['build_directory'], env=env)
+        stages.append(report.stage('configure', start, profile=profile))
+        if fresh and probes.enabled(cfg):
+            probes.save(cfg)
+        with open(fpfile, 'w') as f:
+            f.write(fingerprint)
+    if cfg.get('launch_ccmake', False):
+        fork(['ccmake', '.'], cwd=cfg['build_directory'])
+    return stages
+
+
+# configuration entries that only apply to the current invocation and are not saved in the build directory
+transient_keys = {'build', 'build_directory', 'force_configure', 'profile', 'report', 'trace', 'warm_compiler_cache',
+                  'output', 'test', 'shard', 'affected_since', 'prebuilt_prefixes', 'probe_cache_action',
+                  'matrix_share'}
+
+
+def save_cfg(cfg):
+    if cfg['build']:
+        cfg['extra_args'] = None
+    conf = {key: value for key, value in cfg.items() if key not in transient_keys}
+    with open(join(cfg['build_directory'], cache_file), 'w') as f:
+        json.dump(conf, f)
+
 
-    with DirectoryContext(cfg['build_directory']):
-        fork(cmd)
-        if cfg.get('launch_ccmake', False):
-            fork(['ccmake', '.'])
+def warm_compiler_cache(cfg, prefix=None):
+    """Configures and builds ``cfg`` in a scratch build directory, deleted afterwards, only to fill its compiler
+    cache. Thanks to CCACHE_BASEDIR the other build directories of the project with the same flags hit it"""
+    if compiler_cache.settings(cfg) is None:
+        raise ValueError('Build configuration "%s" does not use a compiler cache' % cfg.get('configuration_name', ''))
+    cfg = dict(cfg, build_directory=cfg['build_directory'] + '-warm', clean=True, build=True, launch_ccmake=False,
+               test=False, affected_since=None, cmake_target=[target for target in cfg.get('cmake_target', None) or []
+                                         if target not in sequential_targets] or None)
+    try:
+        return configure(cfg, prefix=prefix) + build(cfg, prefix=prefix)
+    finally:
+        exists(cfg['build_directory']) and cleanup.remove_async(cfg['build_directory'])
+
+
+def configure_matrix(configurations, update=False):
+    from concurrent.futures import ThreadPoolExecutor
+    if update:
+        # quark checks dependencies out into the source tree, which is not safe to do concurrently
+        for cfg in configurations.values():
+            update_dependencies(cfg)
+
+    def run_one(name, cfg):
+        cfg['launch_ccmake'] = False
+        if cfg.get('trace', None):
+            root, ext = os.path.splitext(cfg['trace'])
+            cfg['trace'] = '%s-%s%s' % (root, name, ext)
+        stages = configure(cfg, prefix=name)
+        if cfg.get('build', False):
+            stages += build(cfg, prefix=name)
+        elif cfg.get('test', False):
+            stages.append(test_stage(cfg, prefix=name))
+        report.finish(cfg, stages, prefix=name)
+        save_cfg(cfg)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(configurations)) as executor:
+        futures = {name: executor.submit(run_one, name, cfg) for name, cfg in configurations.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as err:
+                logger.error('Configuration "%s" failed: %s' % (name, err))
+                failed.append(name)
+    if failed:
+        raise RuntimeError('Failed build configurations: %s' % ', '.join(failed))
 
 
 def configure_cli(default_configuration=None):
     logging.basicConfig(format='%(levelname)s: %(message)s')
     name, cfg, kwargs = parse_cfg(default_configuration)
-    configure(cfg, **kwargs)
+    autotune = kwargs.pop('autotune', None)
+    if autotune is not None:
+        from .autotune import tune
+        if kwargs['update']:
+            update_dependencies(cfg)
+        tune(cfg, **autotune)
+        return name, cfg
+    if kwargs.pop('matrix', False):
+        configure_matrix(cfg, **kwargs)
+        return name, cfg
+    if cfg.get('warm_compiler_cache', False):
+        report.finish(cfg, warm_compiler_cache(cfg))
+        return name, cfg
+    if cfg.get('probe_cache_action', None) == 'clear':
+        probes.clear(cfg)
+        return name, cfg
+    elif cfg.get('probe_cache_action', None) == 'verify':
+        probes.verify(cfg)
+        return name, cfg
+    stages = configure(cfg, **kwargs)
     if cfg.get('build', False):
-        build(cfg)
-    if cfg['build']:
-        cfg['extra_args'] = None
-    with DirectoryContext(cfg['build_directory']):
-        conf = {key:value for key,value in cfg.items() if key not in {'build', 'build_directory'}}
-        with open(cache_file, 'w') as f:
-            json.dump(conf, f)
+        stages += build(cfg)
+    elif cfg.get('test', False):
+        stages.append(test_stage(cfg))
+    report.finish(cfg, stages)
+    save_cfg(cfg)
     return name, cfg
 
 def run():
@@ -0,0 +1,122 @@
+import logging
+import os
+import re
+from os.path import join
+
+from .utils import echo
+
+logger = logging.getLogger(__name__)
+
+tools = ('distcc', 'icecc')
+distcc_log_file = 'czmake_distcc.log'
+
+distcc_completed = re.compile(r'compile (?P<source>\S+) on (?P<host>\S+) completed ok')
+distcc_fallback = re.compile(r'failed to distribute .*running locally instead')
+
+_slots = {}
+
+
+def settings(cfg):
+    """Returns the distributed compilation settings of a configuration as a dict with 'tool' and 'hosts' (and for
+    icecream 'slots'), None if compilations are not distributed. In build.czmake "distribute" can be either the tool
+    name or such a dict"""
+    value = cfg.get('distribute', None)
+    if not value:
+        return None
+    result = {'tool': value} if isinstance(value, str) else dict(value)
+    result.setdefault('tool', 'distcc')
+    if result['tool'] not in tools:
+        raise ValueError('Unsupported distributed compiler "%s", expected one of %s' % (result['tool'], ', '.join(tools)))
+    return result
+
+
+def options(cfg):
+    """Compiler launchers, when a compiler cache is used it runs the distributed compiler itself (CCACHE_PREFIX)"""
+    from .compiler_cache import launcher_options, settings as cache_settings
+    dist = settings(cfg)
+    cache = cache_settings(cfg)
+    if dist is None:
+        # distribution disabled with --distribute none has to be removed from an existing CMake cache as well,
+        # unless the launchers are the compiler cache
+        return {option: '' for option in launcher_options} \
+            if cfg.get('distribute', None) is False and cache is None else {}
+    if cache is None:
+        return {option: dist['tool'] for option in launcher_options}
+    elif cache['tool'] == 'sccache':
+        raise ValueError('sccache cannot be chained with %s, use its own distributed compilation instead'
+                         % dist['tool'])
+    return {}
+
+
+def environment(cfg):
+    from .compiler_cache import settings as cache_settings
+    dist = settings(cfg)
+    if dist is None:
+        return {}
+    env = {}
+    if cache_settings(cfg) is not None:
+        env['CCACHE_PREFIX'] = dist['tool']
+    if dist['tool'] == 'distcc':
+        if dist.get('hosts', None):
+            env['DISTCC_HOSTS'] = dist['hosts']
+        # the log tells where each compilation ran
+        env['DISTCC_LOG'] = join(cfg['build_directory'], distcc_log_file)
+        env['DISTCC_VERBOSE'] = '1'
+    return env
+
+
+def slots(cfg):
+    """Number of compilations that can run at the same time on the hosts, None if unknown"""
+    dist = settings(cfg)
+    if dist is None:
+        return None
+    if dist.get('slots', None):
+        return dist['slots']
+    if dist['tool'] != 'distcc':
+        return None
+    hosts = dist.get('hosts', None) or os.environ.get('DISTCC_HOSTS', None)
+    if hosts not in _slots:
+        import subprocess
+        env = dict(os.environ)
+        if hosts:
+            env['DISTCC_HOSTS'] = hosts
+        try:
+            # distcc sums the slots declared by DISTCC_HOSTS (or its hosts file)
+            _slots[hosts] = int(subprocess.check_output(['distcc', '-j'], env=env, stderr=subprocess.DEVNULL))
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            logger.warning('Unable to get the number of distcc slots: %s' % err)
+            _slots[hosts] = None
+    return _slots[hosts]
+
+
+def reset_log(cfg):
+    dist = settings(cfg)
+    if dist is not None and dist['tool'] == 'distcc':
+        open(join(cfg['build_directory'], distcc_log_file), 'w').close()
+
+
+def summarize(cfg, prefix=None):
+    """Prints how many compilations ran remotely according to the distcc log of the last build"""
+    dist = settings(cfg)
+    if dist is None or dist['tool'] != 'distcc':
+        return
+    hosts = {}
+    fallbacks = 0
+    try:
+        with open(join(cfg['build_directory'], distcc_log_file), 'r', errors='replace') as f:
+            for line in f:
+                match = distcc_completed.search(line)
+                if match:
+                    hosts[match.group('host')] = hosts.get(match.group('host'), 0) + 1
+                elif distcc_fallback.search(line):
+                    fallbacks += 1
+    except FileNotFoundError:
+        return
+    total = sum(hosts.values())
+    if not total:
+        return
+    local = sum(count for host, count in hosts.items() if host.split('/')[0] == 'localhost')
+    echo('-- distcc: %d of %d compilations ran remotely (%.1f%%), %d fell back to the local host' % (
+        total - local, total, 100.0 * (total - local) / total, fallbacks), prefix)
+    for host, count in sorted(hosts.items(), key=lambda item: -item[1]):
+        echo('--   %s: %d' % (host, count), prefix)
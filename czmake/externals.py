@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from os.path import join, exists, expanduser, basename
+
+from .utils import echo, mkdir
+
+logger = logging.getLogger(__name__)
+
+mirror_directory = os.environ.get('CZMAKE_MIRRORS', join(expanduser('~'), '.cache', 'czmake', 'mirrors'))
+externals_file = 'externals.json'
+default_fetch_jobs = 4
+
+
+def parse_uri(uri):
+    """Splits a module URI in (vcs, url, parameters), e.g.
+    'git+ssh://host/repo;commit=abc' -> ('git', 'ssh://host/repo', {'commit': 'abc'})"""
+    url, parameters = uri, {}
+    for separator in (';', '#'):
+        scheme_end = url.find('://')
+        index = url.find(separator, scheme_end + 3 if scheme_end >= 0 else 0)
+        if index >= 0:
+            for item in url[index + 1:].replace('&', ';').split(';'):
+                key, _, value = item.partition('=')
+                if key:
+                    parameters[key] = value
+            url = url[:index]
+    scheme = url.split('://', 1)[0] if '://' in url else ''
+    if scheme.startswith('svn'):
+        return 'svn', url, parameters
+    if scheme.startswith('git+'):
+        url = url[4:]
+    return 'git', url, parameters
+
+
+def _matches(value, expected):
+    if isinstance(expected, bool) or isinstance(value, bool):
+        from .cmake_cache import CMakeCache
+        return CMakeCache.to_bool(str(value)) == CMakeCache.to_bool(str(expected))
+    return str(value) == str(expected)
+
+
+def dependencies(externals, options):
+    """Returns the modules (name -> module object) required by an externals.json content with ``options``"""
+    result = dict(externals.get('depends', {}))
+    for key, optdepend in externals.get('optdepends', {}).items():
+        if key in options and _matches(options[key], optdepend.get('value', True)):
+            result.update(optdepend.get('deps', {}))
+    return result
+
+
+def mirror_path(url, directory=None):
+    import hashlib
+    name = basename(url.rstrip('/'))
+    if not name.endswith('.git'):
+        name += '.git'
+    return join(directory or mirror_directory, '%s-%s' % (hashlib.sha1(url.encode()).hexdigest()[:16], name))
+
+
+@contextmanager
+def locked(path):
+    """Holds an exclusive lock on ``path``.lock (shared by the processes of every workspace) in the context. The
+    lock file may be deleted by its holder (see prebuilt.evict), the lock is taken again when the file that was
+    locked is no longer the one at ``path``.lock"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    while True:
+        lock = open(path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            current, locked_file = os.stat(path + '.lock'), os.fstat(lock.fileno())
+            if (current.st_dev, current.st_ino) == (locked_file.st_dev, locked_file.st_ino):
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+    with lock:
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _git(*args, **kwargs):
+    return subprocess.check_output(('git',) + args, stderr=subprocess.PIPE, **kwargs).decode(errors='replace')
+
+
+def update_mirror(url, directory=None):
+    """Creates or refreshes the bare mirror of the repository at ``url``, shared by every workspace"""
+    path = mirror_path(url, directory)
+    mkdir(os.path.dirname(path))
+    with locked(path):
+        if exists(path):
+            _git('-C', path, 'remote', 'update', '--prune')
+        else:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            _git('clone', '--mirror', '--quiet', url, tmp)
+            os.replace(tmp, path)
+    return path
+
+
+def read_externals(mirror, parameters):
+    """Content of the externals.json of the module mirrored in ``mirror`` at the revision given by ``parameters``"""
+    ref = parameters.get('commit', None) or parameters.get('tag', None) or parameters.get('branch', None) or 'HEAD'
+    try:
+        return json.loads(_git('-C', mirror, 'show', '%s:%s' % (ref, externals_file)))
+    except subprocess.CalledProcessError:
+        return {}
+
+
+def fetch(source_directory, options, jobs=None, directory=None, prefix=None):
+    """Refreshes concurrently the mirrors of all the git externals needed by the project in ``source_directory``
+    and by its externals, recursively. Returns a dict mapping each URL to its mirror path, None for the ones that
+    could not be mirrored"""
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        with open(join(source_directory, externals_file), 'r') as f:
+            externals = json.load(f)
+    except FileNotFoundError:
+        return {}
+    mirrors = {}
+    seen = set()
+
+    def fetch_module(name, module):
+        vcs, url, parameters = parse_uri(module['uri'])
+        start = time.time()
+        try:
+            mirror = update_mirror(url, directory)
+        except (OSError, subprocess.CalledProcessError) as err:
+            logger.warning('Unable to mirror module "%s" from "%s": %s' % (name, url, getattr(err, 'stderr', err)))
+            return url, None, {}
+        echo('-- Fetched %s (%s) in %.2f s' % (name, url, time.time() - start), prefix)
+        module_options = dict(options)
+        module_options.update(module.get('options', {}))
+        return url, mirror, dependencies(read_externals(mirror, parameters), module_options)
+
+    def submit(executor, modules, pending):
+        for name, module in modules.items():
+            vcs, url, _ = parse_uri(module['uri'])
+            if vcs != 'git':
+                # svn externals are left to quark
+                continue
+            if url not in seen:
+                seen.add(url)
+                pending.append(executor.submit(fetch_module, name, module))
+
+    with ThreadPoolExecutor(max_workers=jobs or default_fetch_jobs) as executor:
+        pending = []
+        submit(executor, dependencies(externals, options), pending)
+        while pending:
+            url, mirror, modules = pending.pop(0).result()
+            mirrors[url] = mirror
+            submit(executor, modules, pending)
+    return mirrors
+
+
+@contextmanager
+def using_mirrors(mirrors):
+    """Makes the git processes started in the context fetch the ``mirrors`` (URLs mapped to their mirror, None
+    for the ones without mirror) instead of the original URLs, through url.<mirror>.insteadOf. The clones keep
+    the original URL as their remote"""
+    # insteadOf rewrites the URLs starting with the value, the longest one wins: the URLs without mirror
+    # extending a mirrored one are rewritten to themselves, e.g. .../lib-extra next to a mirrored .../lib
+    rules = [(mirror, url) for url, mirror in sorted(mirrors.items()) if mirror]
+    rules += [(url, url) for url, mirror in sorted(mirrors.items())
+              if not mirror and any(url.startswith(base) for _, base in rules)]
+    original_count = os.environ.get('GIT_CONFIG_COUNT', None)
+    count = int(original_count or '0')
+    added = []
+    for i, (base, url) in enumerate(rules, count):
+        os.environ['GIT_CONFIG_KEY_%d' % i] = 'url.%s.insteadOf' % base
+        os.environ['GIT_CONFIG_VALUE_%d' % i] = url
+        added += ['GIT_CONFIG_KEY_%d' % i, 'GIT_CONFIG_VALUE_%d' % i]
+    os.environ['GIT_CONFIG_COUNT'] = str(count + len(rules))
+    try:
+        yield
+    finally:
+        for key in added:
+            os.environ.pop(key, None)
+        if original_count is None:
+            os.environ.pop('GIT_CONFIG_COUNT', None)
+        else:
+            os.environ['GIT_CONFIG_COUNT'] = original_count
@@ -0,0 +1,220 @@
+import os
+from os.path import join, exists
+
+# defaults in MiB, they can be overridden with --mem-per-job/--mem-per-link-job or in build.czmake
+default_mem_per_job = 1024
+default_mem_per_lto_link_job = 4096
+
+link_pool = 'czmake_link_pool'
+
+
+def add_job_arguments(parser):
+    parser.add_argument("-j", "--jobs", metavar="JOBS", type=int,
+                        help="maximum number of concurrent jobs, defaults to the number of CPUs available to the "
+                             "process (cgroup CPU quota included) bounded by the available memory")
+    parser.add_argument("--load-average", metavar="LOAD", type=float,
+                        help="do not start new jobs while the system load average is above LOAD "
+                             "(Make and Ninja generators)")
+    parser.add_argument("--mem-per-job", metavar="MiB", type=int,
+                        help="memory needed by each compile job, used to bound the default number of jobs "
+                             "(default %d)" % default_mem_per_job)
+    parser.add_argument("--link-jobs", metavar="JOBS", type=int,
+                        help="maximum number of concurrent link jobs (Ninja generators only, through a job pool)")
+    parser.add_argument("--mem-per-link-job", metavar="MiB", type=int,
+                        help="memory needed by each link job when link-time optimization is enabled, used to "
+                             "compute the default --link-jobs (default %d)" % default_mem_per_lto_link_job)
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_mounts():
+    """Returns a dict mapping each cgroup controller (the empty string for cgroup v2) to the root of its hierarchy
+    mounted in the mount namespace of the process and its mount point, read from /proc/self/mountinfo"""
+    result = {}
+    for line in (_read('/proc/self/mountinfo') or '').splitlines():
+        fields = line.split()
+        if '-' not in fields[6:]:
+            continue
+        separator = fields.index('-', 6)
+        root, mount_point, fstype = fields[3], fields[4], fields[separator + 1]
+        if fstype == 'cgroup2':
+            result.setdefault('', (root, mount_point))
+        elif fstype == 'cgroup' and len(fields) > separator + 3:
+            # the controllers are among the super options
+            for option in fields[separator + 3].split(','):
+                result.setdefault(option, (root, mount_point))
+    return result
+
+
+def _cgroup_directory(mount, path):
+    """Directory of the cgroup ``path`` in the hierarchy ``mount`` (root, mount point). Without a cgroup namespace
+    ``path`` is relative to the root of the host hierarchy, of which a container only sees its own cgroup mounted"""
+    root, mount_point = mount
+    if root == '/':
+        directory = join(mount_point, path.lstrip('/'))
+    elif path == root or path.startswith(root.rstrip('/') + '/'):
+        directory = join(mount_point, path[len(root):].lstrip('/'))
+    else:
+        directory = mount_point
+    return directory if exists(directory) else mount_point
+
+
+def _cgroup_paths():
+    """Returns a dict mapping each cgroup controller (the empty string for cgroup v2) to its directory"""
+    mounts = _cgroup_mounts()
+    if not mounts:
+        # the usual mount points, the cgroup v2 hierarchy is in unified/ in hybrid mode
+        unified = '/sys/fs/cgroup/unified'
+        mounts = {'': ('/', unified if exists(unified) else '/sys/fs/cgroup')}
+    result = {}
+    content = _read('/proc/self/cgroup') or ''
+    for line in content.splitlines():
+        _, controllers, path = line.split(':', 2)
+        for controller in controllers.split(','):
+            mount = mounts.get(controller, None) or ('/', join('/sys/fs/cgroup', controller))
+            result[controller] = _cgroup_directory(mount, path)
+    return result
+
+
+def cpu_quota():
+    """Returns the number of CPUs allowed by the cgroup CPU quota, or None if there is no quota"""
+    cgroups = _cgroup_paths()
+    if '' in cgroups:
+        cpu_max = _read(join(cgroups[''], 'cpu.max'))
+        if cpu_max and not cpu_max.startswith('max'):
+            quota, period = cpu_max.split()
+            return int(quota) / int(period)
+    if 'cpu' in cgroups:
+        quota = _read(join(cgroups['cpu'], 'cpu.cfs_quota_us'))
+        period = _read(join(cgroups['cpu'], 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    return None
+
+
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cpu_quota()
+    if quota:
+        cpus = min(cpus, max(1, int(quota + 0.5)))
+    return cpus
+
+
+def _memory(meminfo_key, subtract_usage):
+    result = None
+    meminfo = _read('/proc/meminfo') or ''
+    for line in meminfo.splitlines():
+        if line.startswith(meminfo_key):
+            result = int(line.split()[1]) // 1024
+    cgroups = _cgroup_paths()
+    for directory, limit_file, usage_file in ((cgroups.get(''), 'memory.max', 'memory.current'),
+                                               (cgroups.get('memory'), 'memory.limit_in_bytes',
+                                                'memory.usage_in_bytes')):
+        if directory:
+            limit, usage = _read(join(directory, limit_file)), _read(join(directory, usage_file))
+            if limit and limit.isdigit():
+                if subtract_usage:
+                    if not (usage and usage.isdigit()):
+                        continue
+                    limit = max(0, int(limit) - int(usage))
+                limit = int(limit) // 2 ** 20
+                result = limit if result is None else min(result, limit)
+    return result
+
+
+def available_memory():
+    """Returns the memory currently available to the process in MiB (taking the cgroup limit into account) or None"""
+    return _memory('MemAvailable:', True)
+
+
+def total_memory():
+    """Returns the total memory the process may use in MiB (taking the cgroup limit into account) or None"""
+    return _memory('MemTotal:', False)
+
+
+def lto_enabled(cfg):
+    return bool(cfg.get('options', {}).get('CMAKE_INTERPROCEDURAL_OPTIMIZATION', False))
+
+
+def default_jobs(cfg):
+    """The job budget, shared among the configurations of a matrix built at the same time (cfg['matrix_share'] is
+    their number, it is not saved in the build directory)"""
+    return max(1, _default_jobs(cfg) // (cfg.get('matrix_share', None) or 1))
+
+
+def _default_jobs(cfg):
+    if cfg.get('jobs', None):
+        return cfg['jobs']
+    if cfg.get('distribute', None):
+        from .distribute import slots
+        # compilations run on the hosts, only preprocessing and linking stay local
+        remote = slots(cfg)
+        if remote:
+            return remote
+    jobs = available_cpus()
+    memory = available_memory()
+    if memory is not None:
+        jobs = min(jobs, max(1, memory // (cfg.get('mem_per_job', None) or default_mem_per_job)))
+    return jobs
+
+
+def link_jobs(cfg):
+    if cfg.get('link_jobs', None):
+        return cfg['link_jobs']
+    elif not lto_enabled(cfg):
+        # with distributed compilation -j goes well beyond the local CPUs, links have to be kept to those
+        return available_cpus() if cfg.get('distribute', None) else None
+    # the pool size ends up in the CMake cache, so it is derived from the total memory (which does not change
+    # between runs) rather than from the available one
+    memory = total_memory()
+    if memory is None:
+        return None
+    mem_per_link_job = cfg.get('mem_per_link_job', None) or default_mem_per_lto_link_job
+    return max(1, min(available_cpus(), memory // mem_per_link_job))
+
+
+def job_pool_options(cfg):
+    """CMake options creating a Ninja job pool that limits the number of concurrent link jobs"""
+    jobs = link_jobs(cfg)
+    if jobs is None or 'Ninja' not in cfg.get('generator', ''):
+        return {}
+    return {'CMAKE_JOB_POOLS': '%s=%d' % (link_pool, jobs), 'CMAKE_JOB_POOL_LINK': link_pool}
+
+
+def native_tool(build_directory):
+    if exists(join(build_directory, 'build.ninja')):
+        return 'ninja'
+    elif exists(join(build_directory, 'Makefile')):
+        return 'make'
+    return None
+
+
+def native_args(cfg):
+    """Command line arguments enforcing the job policy on the native build tool"""
+    if native_tool(cfg['build_directory']) is None:
+        return ['-j%d' % default_jobs(cfg)] if cfg.get('jobs', None) else []
+    args = ['-j%d' % default_jobs(cfg)]
+    if cfg.get('load_average', None):
+        args.append('-l%g' % cfg['load_average'])
+    return args
+
+
+def build_env(cfg):
+    env = dict(os.environ)
+    if os.name != 'nt' and 'MAKEFLAGS' not in env:
+        env['MAKEFLAGS'] = "-j%d" % default_jobs(cfg)
+        if cfg.get('load_average', None):
+            env['MAKEFLAGS'] += ' -l%g' % cfg['load_average']
+    from . import compiler_cache, distribute
+    env.update(compiler_cache.environment(cfg))
+    env.update(distribute.environment(cfg))
+    return env
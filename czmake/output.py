@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from os.path import join
+
+from .utils import echo, _output_lock
+
+logger = logging.getLogger(__name__)
+
+modes = ('full', 'quiet', 'progress')
+default_mode = os.environ.get('CZMAKE_OUTPUT', 'full')
+log_file = 'czmake_%s.log.gz'
+diagnostics_file = 'czmake_%s_diagnostics.json'
+
+# lines waiting to be written to the console, when the console cannot keep up further lines are dropped
+# (they still end up in the log) instead of stalling the reader and, through the pipe, the build
+console_queue_size = 10000
+# unique diagnostics kept in the summary
+max_diagnostics = 500
+
+ansi_escape = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+gcc_diagnostic = re.compile(
+    r'^(?P<file>[^:\s][^:]*|[A-Za-z]:[^:]*):(?P<line>\d+):(?:(?P<column>\d+):)?\s+'
+    r'(?P<severity>fatal error|error|warning|note):\s+(?P<message>.*?)(?:\s+\[(?P<flag>-W[^\]]+)\])?$')
+msvc_diagnostic = re.compile(
+    r'^\s*(?P<file>[^()]+)\((?P<line>\d+)(?:,(?P<column>\d+))?\)\s*:\s+'
+    r'(?P<severity>fatal error|error|warning|note)\s+(?P<flag>[A-Z]+\d+)\s*:\s+(?P<message>.*)$')
+cmake_diagnostic = re.compile(r'^CMake (?P<severity>Error|Warning)(?: \(dev\))? at (?P<file>.+):(?P<line>\d+)')
+linker_error = re.compile(r'(?P<message>(?:undefined reference to|multiple definition of|cannot find -l)'
+                          r'.*|.*(?:ld returned \d+ exit status|LNK\d+:.*))$')
+progress_line = re.compile(r'^\[\s*(?:(?P<done>\d+)/(?P<total>\d+)|(?P<percent>\d+)%)\]')
+
+
+class Diagnostics:
+    """Collects the compiler, linker and CMake diagnostics found in the output lines"""
+
+    def __init__(self):
+        self.counts = {'error': 0, 'warning': 0, 'note': 0}
+        self.flags = {}
+        self.first_error = None
+        self.diagnostics = []
+        self._seen = set()
+
+    def parse(self, line):
+        """Returns the diagnostic found in ``line`` as a dict, None if there is none"""
+        match = gcc_diagnostic.match(line) or msvc_diagnostic.match(line)
+        if match:
+            diagnostic = match.groupdict()
+            diagnostic['line'] = int(diagnostic['line'])
+            diagnostic['column'] = int(diagnostic['column']) if diagnostic['column'] else None
+        else:
+            match = cmake_diagnostic.match(line)
+            if match:
+                diagnostic = dict(match.groupdict(), line=int(match.group('line')), column=None, flag=None,
+                                  message=line, severity=match.group('severity').lower())
+            else:
+                match = linker_error.search(line)
+                if not match:
+                    return None
+                diagnostic = {'file': None, 'line': None, 'column': None, 'flag': None, 'severity': 'error',
+                              'message': match.group('message')}
+        if diagnostic['severity'] == 'fatal error':
+            diagnostic['severity'] = 'error'
+        return diagnostic
+
+    def add(self, diagnostic):
+        key = (diagnostic['file'], diagnostic['line'], diagnostic['column'], diagnostic['message'])
+        if key in self._seen:
+            # the same diagnostic in a header is reported once per translation unit including it
+            return
+        self._seen.add(key)
+        severity = diagnostic['severity']
+        self.counts[severity] += 1
+        if severity == 'warning' and diagnostic['flag']:
+            self.flags[diagnostic['flag']] = self.flags.get(diagnostic['flag'], 0) + 1
+        if severity == 'error' and self.first_error is None:
+            self.first_error = diagnostic
+        if severity != 'note' and len(self.diagnostics) < max_diagnostics:
+            self.diagnostics.append(diagnostic)
+
+    def summary(self):
+        return {
+            'errors': self.counts['error'],
+            'warnings': self.counts['warning'],
+            'notes': self.counts['note'],
+            'first_error': self.first_error,
+            'warnings_by_flag': dict(sorted(self.flags.items(), key=lambda item: -item[1])),
+            'diagnostics': self.diagnostics,
+        }
+
+
+def location(diagnostic):
+    parts = [str(part) for part in (diagnostic['file'], diagnostic['line'], diagnostic['column']) if part]
+    return ':'.join(parts)
+
+
+class Output:
+    """Runs commands streaming their output: a reader thread drains the pipe as fast as the process writes,
+    tees it to a gzip log (if ``log_path`` is given) and extracts the diagnostics, while a second thread writes
+    it to the console according to ``mode``:
+
+    - 'full' shows every line
+    - 'quiet' only shows the errors
+    - 'progress' only shows the progress of Ninja and Make (in place on a terminal)
+
+    Several commands can run at the same time through the same Output, their lines are written whole to the log
+    and the diagnostics are collected under a lock"""
+
+    def __init__(self, mode=None, prefix=None, log_path=None):
+        self.mode = mode or default_mode
+        if self.mode not in modes:
+            raise ValueError('Unknown output mode "%s", expected one of %s' % (self.mode, ', '.join(modes)))
+        self.prefix = prefix
+        self.log_path = log_path
+        self.log = None
+        self.diagnostics = Diagnostics()
+        self.lines = 0
+        self.dropped = 0
+        self.in_place = self.mode == 'progress' and prefix is None and sys.stdout.isatty()
+        self._last_progress = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if self.log_path:
+            import gzip
+            self.log = gzip.open(self.log_path, 'wb', compresslevel=1)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def _write_log(self, data):
+        if self.log is not None:
+            try:
+                self.log.write(data)
+            except OSError as err:
+                # keep draining the pipe, losing the log is better than blocking the build
+                logger.warning('Unable to write "%s": %s' % (self.log_path, err))
+                self.log = None
+
+    def _read(self, stream, console):
+        import queue
+        pending = b''
+        while True:
+            chunk = os.read(stream.fileno(), 1 << 16)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            if lines:
+                with self._lock:
+                    self._write_log(b'\n'.join(lines) + b'\n')
+                    for raw in lines:
+                        self._line(raw, console, queue.Full)
+        if pending:
+            with self._lock:
+                self._write_log(pending + b'\n')
+                self._line(pending, console, queue.Full)
+        console.put(None)
+
+    def _line(self, raw, console, full):
+        self.lines += 1
+        text = raw.decode(errors='replace').rstrip('\r')
+        line = ansi_escape.sub('', text)
+        diagnostic = self.diagnostics.parse(line)
+        if diagnostic is not None:
+            self.diagnostics.add(diagnostic)
+        if self.mode == 'quiet':
+            if diagnostic is None or diagnostic['severity'] != 'error':
+                return
+            line = text
+        elif self.mode == 'progress':
+            if diagnostic is not None and diagnostic['severity'] == 'error':
+                line = text
+            elif progress_line.match(line):
+                now = time.time()
+                if not self.in_place and now - self._last_progress < 1:
+                    return
+                self._last_progress = now
+                line = '\r' + line if self.in_place else line
+            else:
+                return
+        else:
+            line = text
+        try:
+            console.put_nowait(line)
+        except full:
+            self.dropped += 1
+
+    def _write(self, console):
+        in_place = False
+        while True:
+            line = console.get()
+            if line is None:
+                break
+            with _output_lock:
+                if line.startswith('\r'):
+                    sys.stdout.write('\r\x1b[K' + line[1:])
+                    in_place = True
+                else:
+                    if in_place:
+                        sys.stdout.write('\n')
+                        in_place = False
+                    sys.stdout.write(line + '\n' if self.prefix is None else '[%s] %s\n' % (self.prefix, line))
+                sys.stdout.flush()
+        if in_place:
+            with _output_lock:
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+
+    def run(self, cmd, **kwargs):
+        import queue
+        import subprocess
+        echo(' '.join(cmd), self.prefix)
+        console = queue.Queue(maxsize=console_queue_size)
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+        reader = threading.Thread(target=self._read, args=(process.stdout, console), daemon=True)
+        writer = threading.Thread(target=self._write, args=(console,), daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            reader.join()
+            writer.join()
+        finally:
+            retcode = process.wait()
+            process.stdout.close()
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            echo('-- %d lines were not shown as the console could not keep up%s' % (
+                dropped, ', see %s' % self.log_path if self.log_path else ''), self.prefix)
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, cmd)
+        return retcode
+
+    def summary(self):
+        result = self.diagnostics.summary()
+        result['lines'] = self.lines
+        result['log'] = self.log_path
+        return result
+
+    def report(self):
+        """Prints the diagnostic counts and the first error"""
+        counts = self.diagnostics.counts
+        if counts['error'] or counts['warning']:
+            message = '-- %d errors, %d warnings' % (counts['error'], counts['warning'])
+            first_error = self.diagnostics.first_error
+            if first_error is not None:
+                message += ', first error at %s: %s' % (location(first_error) or '?', first_error['message'])
+            echo(message, self.prefix)
+
+
+class Session(Output):
+    """Output of the commands run for ``name`` (e.g. 'configure' or 'build') in ``build_directory``: the log is
+    written to czmake_<name>.log.gz and the diagnostics to czmake_<name>_diagnostics.json when it is closed"""
+
+    def __init__(self, build_directory, name, mode=None, prefix=None):
+        super().__init__(mode, prefix, join(build_directory, log_file % name))
+        self.summary_path = join(build_directory, diagnostics_file % name)
+
+    def close(self):
+        if self.log is None:
+            return
+        super().close()
+        tmp = '%s.%d.tmp' % (self.summary_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+        os.replace(tmp, self.summary_path)
+        if self.mode != 'full' or self.diagnostics.counts['error']:
+            self.report()
+
+
+def add_output_arguments(parser):
+    parser.add_argument("--output", choices=modes, metavar='(%s)' % '|'.join(modes),
+                        help="'full' shows the whole output of CMake and of the build tool, 'quiet' only the errors "
+                             "and 'progress' also the build progress (default %s, CZMAKE_OUTPUT). The whole output "
+                             "is always written to BUILD_DIR/czmake_*.log.gz" % default_mode)
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import re
+import time
+from os.path import join, exists, relpath
+
+from .utils import echo, fork, cmake_exe, cmake_version, cmake_tool, write_if_different
+from .cleanup import format_size
+
+logger = logging.getLogger(__name__)
+
+stage_directory = 'czmake_stage'
+packages_directory = 'czmake_packages'
+manifest_file = 'czmake_package_manifest.json'
+cpack_config_file = 'CPackConfig.cmake'
+
+
+def generators(cfg):
+    """The CPack generators to run: the "package_generators" of the configuration or CPACK_GENERATOR"""
+    if cfg.get('package_generators', None):
+        value = cfg['package_generators']
+        return value.split(',') if isinstance(value, str) else list(value)
+    try:
+        with open(join(cfg['build_directory'], cpack_config_file), 'r') as f:
+            match = re.search(r'^set\(CPACK_GENERATOR "([^"]*)"\)', f.read(), re.MULTILINE)
+    except FileNotFoundError:
+        raise ValueError('"%s" not found, the project does not include CPack' % cpack_config_file)
+    return [generator for generator in (match.group(1) if match else 'TGZ').split(';') if generator]
+
+
+def stage(cfg, prefix=None, output=None):
+    """Installs the project with DESTDIR=BUILD_DIR/czmake_stage, emptied first so that the files the project no
+    longer installs are not packaged. Returns the staged install prefix, the install_manifest.txt of the build
+    directory is left as it was"""
+    from .cmake_cache import load_cache
+    from .cleanup import remove_async
+    build_directory = cfg['build_directory']
+    executable = cfg.get('cmake_exe', cmake_exe)
+    directory = os.path.abspath(join(build_directory, stage_directory))
+    build_type = cfg.get('options', {}).get('CMAKE_BUILD_TYPE', None)
+    install_prefix = (load_cache(build_directory) or {}).get('CMAKE_INSTALL_PREFIX', None) or '/usr/local'
+    if exists(directory):
+        remove_async(directory)
+    if cmake_version(executable) >= (3, 15):
+        cmd = [executable, '--install', build_directory]
+        if build_type:
+            cmd += ['--config', build_type]
+    else:
+        cmd = [executable, '-P', join(build_directory, 'cmake_install.cmake')]
+        if build_type:
+            cmd.insert(1, '-DCMAKE_INSTALL_CONFIG_NAME=%s' % build_type)
+    manifest_path = join(build_directory, 'install_manifest.txt')
+    try:
+        with open(manifest_path, 'rb') as f:
+            install_manifest = f.read()
+    except FileNotFoundError:
+        install_manifest = None
+    try:
+        fork(cmd, prefix=prefix, output=output, cwd=build_directory, env=dict(os.environ, DESTDIR=directory))
+    finally:
+        if install_manifest is None:
+            exists(manifest_path) and os.remove(manifest_path)
+        else:
+            with open(manifest_path, 'wb') as f:
+                f.write(install_manifest)
+    staged = join(directory, os.path.splitdrive(install_prefix)[1].lstrip('/\\'))
+    outside = [name for name in sorted(os.listdir(directory))
+               if not (staged + os.sep).startswith(join(directory, name, ''))] if exists(directory) else []
+    if outside:
+        logger.warning('Files installed outside of CMAKE_INSTALL_PREFIX are not packaged: %s' % ', '.join(outside))
+    os.makedirs(staged, exist_ok=True)
+    return staged
+
+
+def manifest(directory, previous=None):
+    """Returns a dict mapping the path of each file in ``directory`` to [size, mtime_ns, mode, digest], the digests
+    of the files whose size and modification time did not change are taken from the ``previous`` manifest"""
+    from .postprocess import file_digest
+    previous = previous or {}
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for name in sorted(filenames) + [d for d in dirnames if os.path.islink(join(dirpath, d))]:
+            path = join(dirpath, name)
+            key = relpath(path, directory)
+            st = os.lstat(path)
+            if os.path.islink(path):
+                result[key] = [0, 0, st.st_mode, 'link:' + os.readlink(path)]
+                continue
+            old = previous.get(key, None)
+            if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                digest = old[3]
+            else:
+                digest = file_digest(path)
+            result[key] = [st.st_size, st.st_mtime_ns, st.st_mode, digest]
+    return result
+
+
+def manifest_digest(files, build_directory):
+    import hashlib
+    sha1 = hashlib.sha1()
+    for path, (size, _, mode, digest) in sorted(files.items()):
+        sha1.update(('%s\0%d\0%o\0%s\n' % (path, size, mode, digest)).encode())
+    # the package metadata (name, version, ...) is in the CPack configuration
+    try:
+        with open(join(build_directory, cpack_config_file), 'rb') as f:
+            sha1.update(f.read())
+    except FileNotFoundError:
+        pass
+    return sha1.hexdigest()
+
+
+def run_cpack(cfg, generator, staged, threads, prefix=None, output=None):
+    """Runs one CPack generator in its own BUILD_DIR/czmake_packages/GENERATOR directory, so that the packages
+    it makes are known, and moves them to the build directory where CPack writes them"""
+    directory = join(cfg['build_directory'], packages_directory, generator)
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if os.path.isfile(join(directory, name)):
+            os.remove(join(directory, name))
+    cmd = [cmake_tool(cfg.get('cmake_exe', cmake_exe), 'cpack'), '-G', generator,
+           '--config', join(cfg['build_directory'], cpack_config_file), '-B', directory,
+           # package the staged tree instead of installing the project again for each generator
+           '-D', 'CPACK_INSTALL_CMAKE_PROJECTS=', '-D', 'CPACK_INSTALLED_DIRECTORIES=%s;.' % staged,
+           # multi-threaded compression (archive generators since CMake 3.18, DEB since 3.20)
+           '-D', 'CPACK_THREADS=%d' % threads]
+    start = time.time()
+    fork(cmd, prefix=prefix, output=output, cwd=cfg['build_directory'])
+    files = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.isfile(join(directory, name)):
+            files.append(join(cfg['build_directory'], name))
+            os.replace(join(directory, name), files[-1])
+    return files, time.time() - start
+
+
+def package(cfg, prefix=None, output=None):
+    """Runs the CPack generators concurrently on the staged install tree, unless its content did not change since
+    the packages were last made. Returns a dict describing the packages"""
+    from concurrent.futures import ThreadPoolExecutor
+    from .jobs import default_jobs
+    build_directory = cfg['build_directory']
+    selected = generators(cfg)
+    manifest_path = join(build_directory, manifest_file)
+    try:
+        with open(manifest_path, 'r') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+    staged = stage(cfg, prefix, output)
+    files = manifest(staged, previous.get('files', None))
+    digest = manifest_digest(files, build_directory)
+    packages = previous.get('packages', {}) if previous.get('digest', None) == digest else {}
+    # the packages are expected in the build directory, as without czmake
+    todo = [generator for generator in selected
+            if not packages.get(generator, None) or not all(exists(path) and os.path.dirname(path) == build_directory
+                                                            for path in packages[generator]['files'])]
+    if not todo:
+        echo('-- Install tree unchanged, packages are up to date', prefix)
+    else:
+        # generators share the job budget for their compression threads
+        threads = max(1, default_jobs(dict(cfg, distribute=None)) // len(todo))
+        with ThreadPoolExecutor(max_workers=len(todo)) as executor:
+            futures = {generator: executor.submit(run_cpack, cfg, generator, staged, threads, prefix, output)
+                       for generator in todo}
+            for generator, future in futures.items():
+                package_files, seconds = future.result()
+                packages[generator] = {'files': package_files, 'seconds': seconds}
+    for generator in selected:
+        for path in packages[generator]['files']:
+            echo('-- %s: %s, %s%s' % (generator, path, format_size(os.path.getsize(path)),
+                                      ' in %.2f s' % packages[generator]['seconds'] if generator in todo else
+                                      ' (unchanged)'), prefix)
+    write_if_different(manifest_path, json.dumps({'digest': digest, 'files': files, 'packages': packages}))
+    return {generator: packages[generator] for generator in selected}
+
+
+def add_package_arguments(parser):
+    parser.add_argument("--package-generators", metavar='GENERATORS',
+                        help="comma separated CPack generators run concurrently by --package (e.g. TGZ,TXZ,DEB), "
+                             "default is CPACK_GENERATOR")
@@ -0,0 +1,166 @@
+import json
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists, expanduser, basename, abspath
+
+from .utils import echo, mkdir
+
+tools = {
+    'strip': ['strip', '-s'],
+    'upx': ['upx', '--best', '-q'],
+}
+upx_cache_directory = os.environ.get('CZMAKE_UPX_CACHE', join(expanduser('~'), '.cache', 'czmake', 'upx'))
+# records of the processed files and copies of their output, in the build directory
+state_directory = 'czmake_postprocess'
+
+
+def file_digest(path, bufsize=1024 * 1024):
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            buffer = f.read(bufsize)
+            if not buffer:
+                break
+            sha1.update(buffer)
+    return sha1.hexdigest()
+
+
+def is_binary(path):
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(4)
+    except OSError:
+        return False
+    return magic == b'\x7fELF' or magic[:2] == b'MZ' or magic in (b'\xcf\xfa\xed\xfe', b'\xce\xfa\xed\xfe')
+
+
+def installed_files(build_directory):
+    """Returns the binaries listed in the install_manifest.txt written by the install target"""
+    try:
+        with open(join(build_directory, 'install_manifest.txt'), 'r') as f:
+            return [line.strip() for line in f if line.strip() and is_binary(line.strip())]
+    except FileNotFoundError:
+        return []
+
+
+def _load_timestamp(ts_filepath):
+    try:
+        with open(ts_filepath, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # missing file or written by an older version (empty)
+        return None
+
+
+def _stat(filepath):
+    """[size, mtime_ns, digest] of ``filepath``"""
+    st = os.stat(filepath)
+    return [st.st_size, st.st_mtime_ns, file_digest(filepath)]
+
+
+def _matches(filepath, entry):
+    st = os.stat(filepath)
+    if not entry or st.st_size != entry[0]:
+        return False
+    return st.st_mtime_ns == entry[1] or file_digest(filepath) == entry[2]
+
+
+def up_to_date(filepath, ts_filepath):
+    """Compares ``filepath`` with the timestamp record of its last run, returns (record, state): state is 'output'
+    when the file is still the processed one, 'input' when it is the same input again (the install step copied the
+    unprocessed binary over the processed one) and None when it changed"""
+    record = _load_timestamp(ts_filepath)
+    if record is None or 'input' not in record:
+        # missing or written by an older version
+        return record, None
+    if _matches(filepath, record['output']):
+        return record, 'output'
+    if _matches(filepath, record['input']):
+        return record, 'input'
+    return record, None
+
+
+def process_file(filepath, steps, ts_filepath=None, cache_directory=None):
+    """Runs the ``steps`` tools ('strip', 'upx') on ``filepath`` unless it did not change since the last run.
+
+    The timestamp record ``ts_filepath`` (next to ``filepath`` by default) keeps the input and the output of the
+    last run, a copy of the output is kept next to it. Returns a (status, seconds) tuple, status is 'processed',
+    'cached' (the output was taken from ``cache_directory``), 'restored' (the same input was installed again and
+    replaced by the kept output) or 'unchanged', seconds is the time spent processing or the time saved otherwise"""
+    if not ts_filepath:
+        ts_filepath = '%s.%s_timestamp' % (filepath, '_'.join(steps))
+    output_copy = ts_filepath + '.output'
+    record, state = up_to_date(filepath, ts_filepath)
+    if state == 'output':
+        return 'unchanged', record.get('seconds', 0.0)
+    if state == 'input' and exists(output_copy):
+        shutil.copyfile(output_copy, filepath)
+        record['output'] = _stat(filepath)
+        with open(ts_filepath, 'w') as f:
+            json.dump(record, f)
+        return 'restored', record.get('seconds', 0.0)
+    source = _stat(filepath)
+    cached = None
+    if cache_directory:
+        key = ' '.join(' '.join(tools[step]) for step in steps)
+        cached = join(cache_directory, '%s-%s' % (source[2], _text_digest(key)))
+    if cached and exists(cached):
+        shutil.copyfile(cached, filepath)
+        status, seconds = 'cached', (_load_timestamp(cached + '.json') or {}).get('seconds', 0.0)
+    else:
+        start = time.perf_counter()
+        for step in steps:
+            subprocess.check_output(tools[step] + [filepath], stderr=subprocess.STDOUT)
+        status, seconds = 'processed', time.perf_counter() - start
+        if cached:
+            mkdir(cache_directory)
+            tmp = '%s.%d.tmp' % (cached, os.getpid())
+            shutil.copyfile(filepath, tmp)
+            with open(cached + '.json', 'w') as f:
+                json.dump({'seconds': seconds}, f)
+            os.replace(tmp, cached)
+    tmp = '%s.%d.tmp' % (output_copy, os.getpid())
+    shutil.copyfile(filepath, tmp)
+    os.replace(tmp, output_copy)
+    with open(ts_filepath, 'w') as f:
+        json.dump({'input': source, 'output': _stat(filepath), 'seconds': seconds}, f)
+    return status, seconds
+
+
+def _text_digest(s):
+    import hashlib
+    return hashlib.sha1(s.encode()).hexdigest()[:12]
+
+
+def timestamp_path(directory, filepath, steps):
+    """Path of the timestamp record of ``filepath`` in ``directory``, out of the install prefix"""
+    return join(directory, '%s-%s.%s_timestamp' % (_text_digest(abspath(filepath)), basename(filepath),
+                                                   '_'.join(steps)))
+
+
+def postprocess(paths, strip=False, upx=False, workers=None, cache_directory=None, prefix=None, directory=None):
+    """Strips and/or compresses ``paths`` concurrently, skipping the files that did not change since the last run.
+    The timestamp records are kept in ``directory``, next to the files when it is None.
+
+    The work is done by the strip/upx processes, the thread pool only dispatches and waits for them"""
+    steps = [tool for tool, enabled in (('strip', strip), ('upx', upx)) if enabled]
+    if not steps or not paths:
+        return
+    if directory:
+        mkdir(directory)
+    saved = 0.0
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        results = executor.map(lambda path: process_file(
+            path, steps, timestamp_path(directory, path, steps) if directory else None, cache_directory), paths)
+        for path, (status, seconds) in zip(paths, results):
+            if status == 'processed':
+                echo('-- %s %s: %.2f s' % ('+'.join(steps), path, seconds), prefix)
+            else:
+                saved += seconds
+                echo('-- %s %s: %s, saved %.2f s' % ('+'.join(steps), path, status, seconds), prefix)
+    if saved:
+        echo('-- Post-processing saved %.2f s on unchanged files' % saved, prefix)
@@ -0,0 +1,346 @@
+"""Binary cache of the external modules, shared by every workspace.
+
+Each git external is built on its own and installed once per module revision, module options, toolchain and
+build type in ``<cache>/<key>``. The configure step of the project then gets the install prefixes through
+CMAKE_PREFIX_PATH and a CZMAKE_PREBUILT_<MODULE> cache variable per module, which the project uses to
+find_package() the module instead of adding its sources. The least recently used modules are evicted when the
+cache grows beyond its maximum size"""
+import json
+import logging
+import os
+import re
+import time
+from os.path import join, exists, expanduser, isabs, realpath
+
+from .utils import echo, fork, dump_option, cmake_exe, cmake_version, write_if_different
+
+logger = logging.getLogger(__name__)
+
+cache_root = os.environ.get('CZMAKE_PREBUILT', join(expanduser('~'), '.cache', 'czmake', 'prebuilt'))
+default_max_size = '20G'
+metadata_suffix = '.json'
+# options of the project that change the binaries of every module
+toolchain_options = ('CMAKE_BUILD_TYPE', 'CMAKE_TOOLCHAIN_FILE', 'CMAKE_C_COMPILER', 'CMAKE_CXX_COMPILER',
+                     'CMAKE_C_FLAGS', 'CMAKE_CXX_FLAGS', 'CMAKE_EXE_LINKER_FLAGS', 'CMAKE_SHARED_LINKER_FLAGS',
+                     'CMAKE_SYSROOT', 'CMAKE_OSX_ARCHITECTURES', 'CMAKE_OSX_DEPLOYMENT_TARGET',
+                     'CMAKE_MSVC_RUNTIME_LIBRARY', 'CMAKE_POSITION_INDEPENDENT_CODE', 'CMAKE_CXX_STANDARD',
+                     'CMAKE_INTERPROCEDURAL_OPTIMIZATION')
+toolchain_env = ('CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS')
+default_compilers = {'C': ('CC', 'cc'), 'CXX': ('CXX', 'c++')}
+toolchain_compiler_pattern = re.compile(r'^\s*set\s*\(\s*CMAKE_(C|CXX)_COMPILER\s+"?([^"\s)]+)', re.MULTILINE)
+configured_compiler_pattern = re.compile(r'^set\(CMAKE_\w+?_COMPILER "([^"]+)"\)', re.MULTILINE)
+
+_digests = {}
+
+
+def settings(cfg):
+    """Returns the prebuilt cache settings of a configuration as a dict with 'modules' (None for all of them),
+    'directory' and 'max_size' (bytes), None if the externals are built with the project. In build.czmake
+    "prebuilt" can be true, a list of module names or such a dict"""
+    from .cleanup import parse_size
+    value = cfg.get('prebuilt', None)
+    if not value:
+        return None
+    if isinstance(value, dict):
+        result = dict(value)
+    elif isinstance(value, (list, str)) and value != 'all':
+        result = {'modules': value.split(',') if isinstance(value, str) else list(value)}
+    else:
+        result = {}
+    if result.get('modules', None) == 'all':
+        result['modules'] = None
+    result.setdefault('modules', None)
+    result['directory'] = result.get('directory', None) or cache_root
+    max_size = result.get('max_size', None) or default_max_size
+    result['max_size'] = parse_size(max_size) if isinstance(max_size, str) else int(max_size)
+    return result
+
+
+def variable(name):
+    """Name of the CMake cache variable holding the install prefix of the module ``name``"""
+    return 'CZMAKE_PREBUILT_%s' % re.sub(r'[^A-Za-z0-9]', '_', name).upper()
+
+
+def _digest(path):
+    from .postprocess import file_digest
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _digests:
+        _digests[key] = file_digest(path)
+    return _digests[key]
+
+
+def toolchain_compilers(path):
+    """Maps each language to the compiler set by the toolchain file ``path``, when it is given literally"""
+    try:
+        with open(path, 'r') as f:
+            content = f.read()
+    except OSError:
+        return {}
+    return {language: compiler for language, compiler in toolchain_compiler_pattern.findall(content)
+            if '${' not in compiler}
+
+
+def compilers(cfg):
+    """Maps each language to the digest of the compiler executable used by default, when it can be found. With a
+    toolchain file the compilers are the ones it sets, not the ones of the host"""
+    import shutil
+    options = cfg.get('options', {})
+    named = toolchain_compilers(toolchain_file(cfg)) if toolchain_file(cfg) is not None else None
+    result = {}
+    for language, (env_name, default) in default_compilers.items():
+        compiler = options.get('CMAKE_%s_COMPILER' % language, None)
+        if not compiler:
+            compiler = named.get(language, None) if named is not None else os.environ.get(env_name, None) or default
+        path = shutil.which(compiler) if compiler else None
+        if path is not None:
+            result[language] = _digest(realpath(path))
+    return result
+
+
+def compiler_digests(paths):
+    """Maps each compiler of ``paths`` to the digest of its executable, None for the missing ones"""
+    return {path: _digest(realpath(path)) if os.path.isfile(path) else None for path in paths}
+
+
+def configured_compilers(files):
+    """compiler_digests() of the compilers found by CMake, according to the CMake<LANG>Compiler.cmake ``files``
+    (names mapped to their content) of CMakeFiles/<version>"""
+    return compiler_digests(sorted({compiler for name, content in files.items()
+                                    if re.match(r'CMake\w+Compiler\.cmake$', name)
+                                    for compiler in configured_compiler_pattern.findall(content)}))
+
+
+def build_directory_compilers(build_directory):
+    """configured_compilers() of a configured build directory"""
+    from .probes import version_directory
+    version = version_directory(build_directory)
+    if version is None:
+        return {}
+    directory = join(build_directory, 'CMakeFiles', version)
+    files = {}
+    for name in os.listdir(directory):
+        if name.endswith('.cmake'):
+            with open(join(directory, name), 'r', errors='replace') as f:
+                files[name] = f.read()
+    return configured_compilers(files)
+
+
+def toolchain_file(cfg):
+    path = cfg.get('options', {}).get('CMAKE_TOOLCHAIN_FILE', None)
+    if not path:
+        return None
+    return path if isabs(path) else join(cfg['build_directory'], path)
+
+
+def toolchain(cfg):
+    """What identifies the toolchain of a configuration: compilers, flags, toolchain file, build type and CMake"""
+    options = cfg.get('options', {})
+    result = {
+        'cmake': list(cmake_version(cfg.get('cmake_exe', None) or cmake_exe)),
+        'generator': cfg.get('generator', None),
+        'options': {key: options[key] for key in toolchain_options if key in options},
+        'env': {key: os.environ[key] for key in toolchain_env if key in os.environ},
+        'compilers': compilers(cfg),
+    }
+    path = toolchain_file(cfg)
+    if path is not None:
+        result['toolchain_file'] = _digest(path)
+    return result
+
+
+def revision(mirror, parameters):
+    from .externals import _git
+    ref = parameters.get('commit', None) or parameters.get('tag', None) or parameters.get('branch', None) or 'HEAD'
+    return _git('-C', mirror, 'rev-parse', '--verify', '%s^{commit}' % ref).strip()
+
+
+def build_module(cfg, name, mirror, commit, module_options, prefixes, path, prefix=None):
+    """Builds the module ``name`` at ``commit`` from its ``mirror`` and installs it in ``path``, ``prefixes`` are
+    the install prefixes of its own dependencies. Returns the configured_compilers() of the build"""
+    from .cleanup import remove_async
+    from .externals import _git
+    from .jobs import build_env, native_args
+    work = '%s.%d.build' % (path, os.getpid())
+    source, build = join(work, 'source'), join(work, 'build')
+    try:
+        os.makedirs(build)
+        _git('clone', '--quiet', '--shared', '--no-checkout', mirror, source)
+        _git('-C', source, 'checkout', '--quiet', commit)
+        if exists(join(source, '.gitmodules')):
+            _git('-C', source, 'submodule', 'update', '--quiet', '--init', '--recursive')
+        options = {key: value for key, value in cfg.get('options', {}).items() if key in toolchain_options}
+        if toolchain_file(cfg) is not None:
+            options['CMAKE_TOOLCHAIN_FILE'] = toolchain_file(cfg)
+        options.update(module_options)
+        options['CMAKE_INSTALL_PREFIX'] = path
+        if prefixes:
+            options['CMAKE_PREFIX_PATH'] = ';'.join(prefixes)
+        executable = cfg.get('cmake_exe', None) or cmake_exe
+        cmd = [executable]
+        if cfg.get('generator', None):
+            cmd += ['-G', cfg['generator']]
+        cmd += [dump_option(key, value) for key, value in options.items()] + [source]
+        env = build_env(cfg)
+        fork(cmd, prefix=prefix, cwd=build, env=env)
+        build_type = options.get('CMAKE_BUILD_TYPE', None)
+        cmd = [executable, '--build', build, '--target', 'install']
+        if build_type:
+            cmd += ['--config', build_type]
+        fork(cmd + ['--'] + native_args(dict(cfg, build_directory=build)), prefix=prefix, env=env)
+        return build_directory_compilers(build)
+    except BaseException:
+        exists(path) and remove_async(path)
+        raise
+    finally:
+        exists(work) and remove_async(work)
+
+
+def prepare(cfg, prefix=None):
+    """Makes sure that the git externals of the project are in the prebuilt cache, building the missing ones.
+    Returns a dict mapping each module name to its install prefix"""
+    import hashlib
+    from . import externals
+    from .cleanup import disk_usage, format_size, remove_async
+    spec = settings(cfg)
+    if spec is None:
+        return {}
+    try:
+        with open(join(cfg['source_directory'], externals.externals_file), 'r') as f:
+            project_externals = json.load(f)
+    except FileNotFoundError:
+        return {}
+    identity = toolchain(cfg)
+    mirror_directory = cfg.get('mirror_directory', None)
+    os.makedirs(spec['directory'], exist_ok=True)
+    entries = {}
+
+    def resolve(name, module, stack):
+        """Returns the key and the install prefix of ``module``, None if it cannot be prebuilt"""
+        if name in entries:
+            return entries[name]
+        if name in stack:
+            raise ValueError('Dependency loop detected with module "%s"' % name)
+        vcs, url, parameters = externals.parse_uri(module['uri'])
+        if vcs != 'git':
+            logger.warning('Module "%s" is not a git module, it cannot be prebuilt' % name)
+            entries[name] = None
+            return None
+        mirror = externals.mirror_path(url, mirror_directory)
+        if not exists(mirror):
+            externals.update_mirror(url, mirror_directory)
+        commit = revision(mirror, parameters)
+        module_options = module.get('options', {})
+        dependencies = []
+        for dependency, dependency_module in sorted(
+                externals.dependencies(externals.read_externals(mirror, {'commit': commit}), module_options).items()):
+            entry = resolve(dependency, dependency_module, stack + [name])
+            if entry is not None:
+                dependencies.append(entry)
+        key = hashlib.sha1(json.dumps({'url': url, 'commit': commit, 'options': module_options,
+                                       'toolchain': identity, 'dependencies': [key for key, _ in dependencies]},
+                                      sort_keys=True).encode()).hexdigest()
+        path = join(spec['directory'], key)
+        metadata = path + metadata_suffix
+        with externals.locked(path):
+            try:
+                with open(metadata, 'r') as f:
+                    used = json.load(f).get('compilers', {})
+            except (OSError, ValueError):
+                used = None
+            if used is not None and compiler_digests(used) != used:
+                # a compiler was upgraded in place
+                echo('-- The compiler of the prebuilt %s %s changed, it is built again' % (name, commit[:12]), prefix)
+                os.remove(metadata)
+                exists(path) and remove_async(path)
+                used = None
+            if used is not None:
+                os.utime(metadata)
+                echo('-- Prebuilt %s %s: %s' % (name, commit[:12], path), prefix)
+            else:
+                echo('-- Building %s %s in the prebuilt cache' % (name, commit[:12]), prefix)
+                start = time.time()
+                used = build_module(cfg, name, mirror, commit, module_options, [path for _, path in dependencies],
+                                    path, prefix)
+                size = disk_usage(path)
+                write_if_different(metadata, json.dumps({'module': name, 'url': url, 'commit': commit,
+                                                         'options': module_options, 'size': size,
+                                                         'compilers': used}, indent=4))
+                echo('-- Built %s in %.2f s, %s' % (name, time.time() - start, format_size(size)), prefix)
+        entries[name] = key, path
+        return entries[name]
+
+    modules = externals.dependencies(project_externals, cfg['options'])
+    for name in spec['modules'] or []:
+        if name not in modules:
+            logger.warning('Module "%s" is not an external of the project, it will not be prebuilt' % name)
+    for name, module in sorted(modules.items()):
+        if spec['modules'] is None or name in spec['modules']:
+            resolve(name, module, [])
+    result = {name: entry[1] for name, entry in entries.items() if entry is not None}
+    evict(spec['directory'], spec['max_size'], set(result.values()), prefix)
+    return result
+
+
+def evict(directory, max_size, keep=(), prefix=None):
+    """Deletes the least recently used modules of the cache in ``directory`` until it takes at most ``max_size``
+    bytes, except the install prefixes in ``keep``. Returns the deleted prefixes"""
+    from .cleanup import remove_async, format_size
+    from . import externals
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(metadata_suffix):
+            continue
+        metadata = join(directory, name)
+        try:
+            with open(metadata, 'r') as f:
+                size = json.load(f).get('size', 0)
+            entries.append((os.stat(metadata).st_mtime, size, metadata[:-len(metadata_suffix)]))
+        except (OSError, ValueError):
+            continue
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for used, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path in keep:
+            continue
+        # another workspace may be building or using the module
+        with externals.locked(path):
+            try:
+                if os.stat(path + metadata_suffix).st_mtime != used:
+                    continue
+            except FileNotFoundError:
+                continue
+            os.remove(path + metadata_suffix)
+            exists(path) and remove_async(path)
+            exists(path + '.lock') and os.remove(path + '.lock')
+        removed.append(path)
+        total -= size
+    if removed:
+        echo('-- Evicted %d modules from the prebuilt cache, %s left' % (len(removed), format_size(total)), prefix)
+    return removed
+
+
+def options(cfg):
+    """CMake options pointing the project to the prebuilt modules"""
+    prefixes = cfg.get('prebuilt_prefixes', None)
+    if not prefixes:
+        return {}
+    result = {variable(name): path for name, path in sorted(prefixes.items())}
+    search_path = list(dict.fromkeys(path for _, path in sorted(prefixes.items())))
+    if cfg.get('options', {}).get('CMAKE_PREFIX_PATH', None):
+        search_path.append(cfg['options']['CMAKE_PREFIX_PATH'])
+    result['CMAKE_PREFIX_PATH'] = ';'.join(search_path)
+    return result
+
+
+def add_prebuilt_arguments(parser):
+    parser.add_argument("--prebuilt", nargs='?', const='all', metavar='MODULES',
+                        help="build the git externals (all of them or the comma separated MODULES) once per revision, "
+                             "options and toolchain in a binary cache shared by every workspace (default "
+                             "~/.cache/czmake/prebuilt, CZMAKE_PREBUILT) and pass their install prefix to CMake "
+                             "through CMAKE_PREFIX_PATH and CZMAKE_PREBUILT_<MODULE>, 'none' disables it")
+    parser.add_argument("--prebuilt-cache-size", metavar='SIZE',
+                        help="maximum size of the prebuilt cache, the least recently used modules are evicted beyond "
+                             "it (default %s)" % default_max_size)
@@ -0,0 +1,200 @@
+"""Cache of the toolchain probes made by CMake in new build directories.
+
+The first configure of a build directory identifies the compilers, detects their ABI and runs the check_*()
+macros of the project, each of them a try-compile. Their results are stored once per toolchain (compilers,
+flags, toolchain file, build type, generator and CMake version) and new build directories are seeded with them:
+the CMakeFiles/<version>/*.cmake files are copied and the cache entries are given to CMake through -C, so that
+only the first configure with a toolchain pays for the probes"""
+import json
+import logging
+import os
+from os.path import join, exists, expanduser, isdir
+
+from .utils import echo, write_if_different
+from .cmake_cache import load_cache
+
+logger = logging.getLogger(__name__)
+
+cache_root = os.environ.get('CZMAKE_PROBE_CACHE', join(expanduser('~'), '.cache', 'czmake', 'probes'))
+toolchain_file = 'toolchain.json'
+seed_file = 'czmake_probe_seed.cmake'
+# help strings of the cache entries written by the check_*() macros and the TEST_BIG_ENDIAN like modules
+check_helps = ('Have ', 'Test ', 'Result of ', 'CHECK_TYPE_SIZE')
+platform_entries = ('CMAKE_PLATFORM_INFO_INITIALIZED', 'CMAKE_EXECUTABLE_FORMAT', 'CMAKE_UNAME')
+
+
+def enabled(cfg):
+    return cfg.get('probe_cache', True) is not False
+
+
+def entry_directory(cfg):
+    import hashlib
+    from .prebuilt import toolchain
+    return join(cache_root, hashlib.sha1(json.dumps(toolchain(cfg), sort_keys=True).encode()).hexdigest())
+
+
+def checks_file(cfg):
+    """The check results are kept per project, the same variable may test something else in another one"""
+    import hashlib
+    return 'checks-%s.json' % hashlib.sha1(os.path.abspath(cfg['source_directory']).encode()).hexdigest()[:16]
+
+
+def version_directory(build_directory):
+    """Name of the CMakeFiles/<version> directory holding the compiler information, None if there is none"""
+    try:
+        names = sorted(name for name in os.listdir(join(build_directory, 'CMakeFiles'))
+                       if name[:1].isdigit() and isdir(join(build_directory, 'CMakeFiles', name)))
+    except FileNotFoundError:
+        return None
+    return names[-1] if names else None
+
+
+def results(build_directory):
+    """Returns the probe results of a configured build directory as (toolchain, checks): the former holds the
+    CMakeFiles/<version> files, the digests of the compilers they name and the cache entries set while finding
+    the tools, the latter the cache entries of the checks. Entries are [type, value, help, advanced]"""
+    from .prebuilt import configured_compilers
+    cache = load_cache(build_directory, keep_help=True)
+    version = version_directory(build_directory)
+    if cache is None or version is None:
+        return None, None
+    directory = join(build_directory, 'CMakeFiles', version)
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.cmake'):
+            with open(join(directory, name), 'r') as f:
+                files[name] = f.read()
+    tools, checks = {}, {}
+    for key, value in cache.items():
+        entry = [cache.types[key], value, cache.helps.get(key, '').replace('\n', ' '), cache.is_advanced(key)]
+        if key in platform_entries or (cache.types[key] == 'FILEPATH' and key.startswith('CMAKE_')):
+            tools[key] = entry
+        elif cache.types[key] == 'INTERNAL' and entry[2].startswith(check_helps):
+            checks[key] = entry
+    return {'version': version, 'files': files, 'compilers': configured_compilers(files), 'entries': tools}, checks
+
+
+def _quote(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+
+
+def initial_cache(entries):
+    """Content of a script for cmake -C setting the cache ``entries``"""
+    lines = []
+    for key, (ty, value, help_string, advanced) in sorted(entries.items()):
+        lines.append('set(%s %s CACHE %s %s)' % (key, _quote(value), ty, _quote(help_string)))
+        if advanced:
+            lines.append('mark_as_advanced(%s)' % key)
+    return '\n'.join(lines) + '\n'
+
+
+def _load(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def seed(cfg, prefix=None):
+    """Copies the cached probe results for the toolchain of ``cfg`` in its (new) build directory, returns the
+    path of the initial cache script to pass to CMake with -C, None if nothing is cached for the toolchain or if
+    one of its compilers changed since (a toolchain file may name them, they are not part of the cache key)"""
+    from .prebuilt import compiler_digests
+    directory = entry_directory(cfg)
+    toolchain = _load(join(directory, toolchain_file))
+    if toolchain is None:
+        return None
+    if compiler_digests(toolchain.get('compilers', {})) != toolchain.get('compilers', {}):
+        echo('-- A compiler of the toolchain changed since its probes were cached, they are run again', prefix)
+        return None
+    build_directory = cfg['build_directory']
+    target = join(build_directory, 'CMakeFiles', toolchain['version'])
+    os.makedirs(target, exist_ok=True)
+    for name, content in toolchain['files'].items():
+        with open(join(target, name), 'w') as f:
+            f.write(content)
+    entries = dict(toolchain['entries'])
+    entries.update(_load(join(directory, checks_file(cfg))) or {})
+    path = os.path.abspath(join(build_directory, seed_file))
+    with open(path, 'w') as f:
+        f.write(initial_cache(entries))
+    return path
+
+
+def save(cfg):
+    """Stores the probe results of the freshly configured build directory of ``cfg``"""
+    toolchain, checks = results(cfg['build_directory'])
+    if toolchain is None:
+        return
+    directory = entry_directory(cfg)
+    os.makedirs(directory, exist_ok=True)
+    previous = _load(join(directory, toolchain_file))
+    write_if_different(join(directory, toolchain_file), json.dumps(toolchain, indent=4, sort_keys=True))
+    # a seeded configure only runs the checks that were not cached yet, the ones made with other compilers are stale
+    merged = (_load(join(directory, checks_file(cfg))) or {}) \
+        if previous is not None and previous.get('compilers', None) == toolchain['compilers'] else {}
+    merged.update(checks)
+    write_if_different(join(directory, checks_file(cfg)), json.dumps(merged, indent=4, sort_keys=True))
+
+
+def clear(cfg, prefix=None):
+    """Forgets the probe results of the toolchain of ``cfg``"""
+    from .cleanup import remove_async
+    directory = entry_directory(cfg)
+    if exists(directory):
+        remove_async(directory)
+        echo('-- Cleared the toolchain probe cache %s' % directory, prefix)
+    else:
+        echo('-- No toolchain probe cached for this configuration', prefix)
+
+
+def compare(cached, fresh):
+    """Returns the names of the entries or files of ``cached`` that differ from ``fresh``"""
+    return sorted(key for key in set(cached) | set(fresh) if cached.get(key, None) != fresh.get(key, None))
+
+
+def verify(cfg, prefix=None):
+    """Configures ``cfg`` from scratch without the cache in a scratch build directory, deleted afterwards, and
+    compares its probe results with the cached ones, which are replaced. Returns the names of the differences"""
+    from .cleanup import remove_async
+    from .configure import configure
+    directory = entry_directory(cfg)
+    cached_toolchain = _load(join(directory, toolchain_file))
+    cached_checks = _load(join(directory, checks_file(cfg)))
+    if cached_toolchain is None:
+        echo('-- No toolchain probe cached for this configuration, nothing to verify', prefix)
+        return []
+    scratch = dict(cfg, build_directory=cfg['build_directory'] + '-probes', clean=True, build=False,
+                   launch_ccmake=False, force_configure=True, probe_cache=False,
+                   output=cfg.get('output', None) or 'quiet')
+    try:
+        configure(scratch, prefix=prefix)
+        toolchain, checks = results(scratch['build_directory'])
+    finally:
+        exists(scratch['build_directory']) and remove_async(scratch['build_directory'])
+    if toolchain is None:
+        echo('-- Unable to probe the toolchain, the cached results were kept', prefix)
+        return []
+    differences = ['CMakeFiles/%s/%s' % (toolchain['version'], name)
+                   for name in compare(cached_toolchain['files'], toolchain['files'])]
+    differences += compare(cached_toolchain['entries'], toolchain['entries'])
+    # checks that the scratch configure did not run are compared only when they are cached
+    differences += [key for key in compare(cached_checks or {}, checks) if key in checks]
+    if cached_toolchain['version'] != toolchain['version']:
+        differences.insert(0, 'CMake version')
+    for name in differences:
+        echo('-- Stale probe result: %s' % name, prefix)
+    os.makedirs(directory, exist_ok=True)
+    write_if_different(join(directory, toolchain_file), json.dumps(toolchain, indent=4, sort_keys=True))
+    write_if_different(join(directory, checks_file(cfg)), json.dumps(checks, indent=4, sort_keys=True))
+    echo('-- Toolchain probe cache %s: %s' % (
+        directory, '%d stale results replaced' % len(differences) if differences else 'up to date'), prefix)
+    return differences
+
+
+def add_probe_arguments(parser):
+    parser.add_argument("--probe-cache", choices=('clear', 'verify'),
+                        help="forget the compiler and check results cached for the toolchain of the configuration "
+                             "(new build directories are seeded with them, default ~/.cache/czmake/probes, "
+                             "CZMAKE_PROBE_CACHE) or compare them with a configure from scratch and exit")
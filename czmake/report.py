@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import time
+from os.path import join, exists, dirname, expanduser, getsize
+
+from .utils import echo, mkdir
+
+logger = logging.getLogger(__name__)
+
+ninja_log_file = '.ninja_log'
+profile_file = 'czmake_configure_profile.json'
+history_file = os.environ.get('CZMAKE_HISTORY', join(expanduser('~'), '.cache', 'czmake', 'history.sqlite'))
+
+object_suffixes = ('.o', '.obj')
+
+
+def stage(name, start, **kwargs):
+    result = {'name': name, 'start': start, 'duration': time.time() - start}
+    result.update(kwargs)
+    return result
+
+
+def ninja_log_offset(build_directory):
+    path = join(build_directory, ninja_log_file)
+    return getsize(path) if exists(path) else 0
+
+
+def read_ninja_log(build_directory, offset=0):
+    """Returns the (start_ms, end_ms, output) edges appended to .ninja_log after ``offset``,
+    times are relative to the start of the ninja invocation"""
+    edges = {}
+    try:
+        with open(join(build_directory, ninja_log_file), 'r', errors='replace') as f:
+            if offset:
+                f.seek(offset)
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 4:
+                    continue
+                edges[fields[3]] = (int(fields[0]), int(fields[1]), fields[3])
+    except FileNotFoundError:
+        pass
+    return sorted(edges.values())
+
+
+def slowest(stages, limit):
+    units, targets = [], []
+    for s in stages:
+        for start_ms, end_ms, output in s.get('edges', []):
+            (units if output.endswith(object_suffixes) else targets).append(((end_ms - start_ms) / 1000.0, output))
+    units.sort(reverse=True)
+    targets.sort(reverse=True)
+    return units[:limit], targets[:limit]
+
+
+def print_report(stages, limit, prefix=None):
+    for s in stages:
+        echo('%8.2f s  %s' % (s['duration'], s['name']), prefix)
+    units, targets = slowest(stages, limit)
+    for title, entries in (('translation units', units), ('targets', targets)):
+        if entries:
+            echo('Slowest %s:' % title, prefix)
+            for seconds, output in entries:
+                echo('%8.2f s  %s' % (seconds, output), prefix)
+
+
+def _lanes(edges):
+    lanes, result = [], []
+    for start_ms, end_ms, output in edges:
+        for index, busy_until in enumerate(lanes):
+            if busy_until <= start_ms:
+                lanes[index] = end_ms
+                break
+        else:
+            index = len(lanes)
+            lanes.append(end_ms)
+        result.append((index, start_ms, end_ms, output))
+    return result
+
+
+def write_trace(stages, trace_file):
+    """Exports the stages and the ninja edges in the Chrome trace event format (also read by Perfetto)"""
+    origin = min(s['start'] for s in stages)
+    events = []
+    for s in stages:
+        ts = (s['start'] - origin) * 1e6
+        events.append({'name': s['name'], 'cat': 'stage', 'ph': 'X', 'pid': 0, 'tid': 0,
+                       'ts': ts, 'dur': s['duration'] * 1e6})
+        for lane, start_ms, end_ms, output in _lanes(s.get('edges', [])):
+            events.append({'name': output, 'cat': 'edge', 'ph': 'X', 'pid': 1, 'tid': lane,
+                           'ts': ts + start_ms * 1000, 'dur': (end_ms - start_ms) * 1000})
+        if s.get('profile', None):
+            try:
+                with open(s['profile'], 'r') as f:
+                    profile = json.load(f)
+            except (OSError, ValueError) as err:
+                logger.warning('Unable to read CMake profiling output "%s": %s' % (s['profile'], err))
+                continue
+            profile = profile.get('traceEvents', []) if isinstance(profile, dict) else profile
+            first = min((event['ts'] for event in profile if 'ts' in event), default=0)
+            for event in profile:
+                if 'ts' in event:
+                    event = dict(event, pid=2, ts=ts + event['ts'] - first)
+                events.append(event)
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'ninja'}})
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': 2, 'args': {'name': 'cmake'}})
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def source_revision(source_directory):
+    import subprocess
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=source_directory,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _open_history():
+    import sqlite3
+    mkdir(dirname(history_file))
+    db = sqlite3.connect(history_file, timeout=30)
+    db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, time REAL, project TEXT, '
+               'configuration TEXT, revision TEXT, duration REAL)')
+    db.execute('CREATE TABLE IF NOT EXISTS stages (run INTEGER, name TEXT, duration REAL)')
+    return db
+
+
+def record_history(cfg, stages):
+    if not history_file or not stages:
+        return
+    try:
+        db = _open_history()
+        with db:
+            cursor = db.execute('INSERT INTO runs (time, project, configuration, revision, duration) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (stages[0]['start'], cfg.get('project_directory', None),
+                                 cfg.get('configuration_name', None), source_revision(cfg.get('source_directory', cfg['build_directory'])),
+                                 sum(s['duration'] for s in stages)))
+            db.executemany('INSERT INTO stages (run, name, duration) VALUES (?, ?, ?)',
+                           [(cursor.lastrowid, s['name'], s['duration']) for s in stages])
+        db.close()
+    except Exception as err:
+        logger.warning('Unable to record build history in "%s": %s' % (history_file, err))
+
+
+def print_history(cfg, limit=10):
+    db = _open_history()
+    rows = db.execute('SELECT time, revision, duration FROM runs WHERE project IS ? AND configuration IS ? '
+                      'ORDER BY time DESC LIMIT ?',
+                      (cfg.get('project_directory', None), cfg.get('configuration_name', None), limit)).fetchall()
+    db.close()
+    previous = None
+    for timestamp, revision, duration in reversed(rows):
+        delta = '' if previous is None else '%+8.2f s' % (duration - previous)
+        print('%s  %-12s %8.2f s %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                                       (revision or '-')[:12], duration, delta))
+        previous = duration
+
+
+def finish(cfg, stages, prefix=None):
+    if cfg.get('report', None):
+        print_report(stages, cfg['report'], prefix)
+    if cfg.get('trace', None) and stages:
+        write_trace(stages, cfg['trace'])
+    record_history(cfg, stages)
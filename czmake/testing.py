@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import re
+from os.path import join, dirname
+
+from .utils import echo, fork, str2bool, cmake_tool
+
+logger = logging.getLogger(__name__)
+
+times_file = 'czmake_test_times.json'
+cost_data_file = join('Testing', 'Temporary', 'CTestCostData.txt')
+last_test_log = join('Testing', 'Temporary', 'LastTest.log')
+# assumed duration of the tests that never ran, in seconds
+default_duration = 1.0
+
+
+def parse_shard(value):
+    """Parses 'i/N' (1 <= i <= N) into (i, N)"""
+    match = re.match(r'^(\d+)/(\d+)$', value or '')
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError('Invalid shard "%s", expected INDEX/COUNT with 1 <= INDEX <= COUNT' % value)
+    return int(match.group(1)), int(match.group(2))
+
+
+def list_tests(ctest, build_directory):
+    import subprocess
+    try:
+        output = subprocess.check_output([ctest, '--show-only=json-v1'], cwd=build_directory,
+                                         stderr=subprocess.DEVNULL)
+        return [test['name'] for test in json.loads(output.decode()).get('tests', [])]
+    except (subprocess.CalledProcessError, ValueError):
+        # CMake < 3.14
+        output = subprocess.check_output([ctest, '-N'], cwd=build_directory).decode(errors='replace')
+        return re.findall(r'^\s*Test\s+#\d+: (.+?)\s*$', output, re.MULTILINE)
+
+
+def load_times(build_directory):
+    try:
+        with open(join(build_directory, times_file), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_cost_data(build_directory):
+    """Returns the average duration of each test according to CTest, and the tests that failed last time"""
+    costs, failed = {}, []
+    try:
+        with open(join(build_directory, cost_data_file), 'r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return costs, failed
+    in_failed = False
+    for line in lines:
+        if line == '---':
+            in_failed = True
+        elif in_failed:
+            failed.append(line)
+        else:
+            fields = line.rsplit(' ', 2)
+            if len(fields) == 3:
+                try:
+                    costs[fields[0]] = float(fields[2])
+                except ValueError:
+                    pass
+    return costs, failed
+
+
+def read_durations(build_directory):
+    """Returns the duration of each test of the last CTest run, from its log"""
+    durations = {}
+    name = None
+    try:
+        with open(join(build_directory, last_test_log), 'r', errors='replace') as f:
+            for line in f:
+                match = re.match(r'^\d+/\d+ Test: (.+)$', line.rstrip('\n'))
+                if match:
+                    name = match.group(1)
+                    continue
+                match = re.match(r'^Test time =\s+([\d.]+) sec', line)
+                if match and name is not None:
+                    durations[name] = float(match.group(1))
+                    name = None
+    except FileNotFoundError:
+        pass
+    return durations
+
+
+def seed_cost_data(build_directory, times):
+    """Writes the recorded durations in the cost data of CTest, which CTest uses to start the longest tests first
+    (its own costs are running averages that do not survive a new build directory)"""
+    costs, failed = read_cost_data(build_directory)
+    if all(costs.get(name, None) == duration for name, duration in times.items()):
+        return
+    costs.update(times)
+    path = join(build_directory, cost_data_file)
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        for name, cost in costs.items():
+            f.write('%s 1 %g\n' % (name, cost))
+        f.write('---\n')
+        for name in failed:
+            f.write(name + '\n')
+
+
+def shard(tests, times, index, count):
+    """Splits ``tests`` in ``count`` shards of similar total duration (longest processing time first),
+    returns the tests of the shard ``index`` (1-based). Every machine computes the same split from the same times"""
+    known = [times[name] for name in tests if name in times]
+    fallback = sorted(known)[len(known) // 2] if known else default_duration
+    loads = [0.0] * count
+    shards = [[] for _ in range(count)]
+    for name in sorted(tests, key=lambda name: (-times.get(name, fallback), name)):
+        target = loads.index(min(loads))
+        shards[target].append(name)
+        loads[target] += times.get(name, fallback)
+    return shards[index - 1], loads[index - 1]
+
+
+def test_command(cfg):
+    """The CTest command line running all the tests of the build directory of ``cfg`` with the job budget"""
+    from .jobs import default_jobs
+    from .utils import cmake_exe
+    # the tests run locally even when the compilations are distributed
+    cmd = [cmake_tool(cfg.get('cmake_exe', None) or cmake_exe, 'ctest'), '--output-on-failure',
+           '-j%d' % default_jobs(dict(cfg, distribute=None))]
+    build_type = cfg.get('options', {}).get('CMAKE_BUILD_TYPE', None)
+    if build_type:
+        cmd += ['-C', build_type]
+    return cmd
+
+
+def run_tests(cfg, prefix=None, output=None, tests=None):
+    """Runs the tests of the build directory (only the ``tests`` if given) with CTest using the job budget, records
+    their durations. Returns the number of tests run"""
+    build_directory = cfg['build_directory']
+    cmd = test_command(cfg)
+    ctest = cmd[0]
+    times = load_times(build_directory)
+    seed_cost_data(build_directory, times)
+    if cfg.get('shard', None):
+        index, count = parse_shard(cfg['shard'])
+        tests, load = shard(list_tests(ctest, build_directory) if tests is None else tests, times, index, count)
+        echo('-- Shard %d/%d: %d tests, about %.1f s' % (index, count, len(tests), load), prefix)
+    if tests is not None:
+        if not tests:
+            return 0
+        cmd += ['-R', '^(%s)$' % '|'.join(re.escape(name) for name in tests)]
+    try:
+        fork(cmd, prefix=prefix, output=output, cwd=build_directory)
+    finally:
+        times.update(read_durations(build_directory))
+        tmp = join(build_directory, '%s.%d.tmp' % (times_file, os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump(times, f, indent=4, sort_keys=True)
+        os.replace(tmp, join(build_directory, times_file))
+    return len(tests) if tests is not None else len(list_tests(ctest, build_directory))
+
+
+def add_test_arguments(parser):
+    parser.add_argument("--test", type=str2bool, nargs='?', const=True, metavar='(true|false)',
+                        help="run the tests with CTest after the build, the longest first according to the durations "
+                             "recorded in the build directory (%s)" % times_file)
+    parser.add_argument("--shard", metavar='INDEX/COUNT',
+                        help="with --test, only run the INDEX-th (from 1) of COUNT groups of tests of similar total "
+                             "duration")
@@ -1,12 +1,15 @@
 import sys
 import os
 import os.path
-import subprocess
 import argparse
-import hashlib
+import threading
+
+# The entry points are run very often from editors and wrapper scripts: modules that are only
+# needed on some code paths (subprocess, hashlib, re, ...) are imported where they are used.
 
 cmake_exe = os.environ.get('CZMAKE_CMAKE', 'cmake')
 cache_file = os.path.join('czmake_cache.json')
+fingerprint_file = 'czmake_fingerprint'
 
 def update_dict(original, updated):
     for key, value in updated.items():
@@ -18,9 +21,53 @@ def update_dict(original, updated):
         elif fixed_key in original and value:
             original[fixed_key] = value
 
-def fork(*args, **kwargs):
-    sys.stdout.write(' '.join(args[0]) + '\n')
-    return subprocess.check_call(*args, **kwargs)
+_output_lock = threading.Lock()
+
+
+def echo(message, prefix=None):
+    with _output_lock:
+        if prefix is None:
+            sys.stdout.write(message + '\n')
+        else:
+            sys.stdout.write('[%s] %s\n' % (prefix, message))
+        sys.stdout.flush()
+
+
+def fork(cmd, prefix=None, output=None, **kwargs):
+    """Runs ``cmd`` raising CalledProcessError if it fails. With a ``prefix`` (or an ``output.Output``) the output
+    of the process is streamed through czmake, otherwise the process writes directly to the console"""
+    if output is None:
+        if prefix is None:
+            import subprocess
+            echo(' '.join(cmd), prefix)
+            return subprocess.check_call(cmd, **kwargs)
+        from .output import Output
+        output = Output(prefix=prefix)
+    return output.run(cmd, **kwargs)
+
+
+def cmake_tool(executable, name):
+    """The path of the CMake tool ``name`` (e.g. 'ctest' or 'cpack') installed next to the cmake ``executable``"""
+    directory, base = os.path.split(executable)
+    tool = base.replace('cmake', name) if 'cmake' in base else name
+    return os.path.join(directory, tool) if directory else tool
+
+
+_cmake_versions = {}
+
+
+def cmake_version(executable=cmake_exe):
+    if executable not in _cmake_versions:
+        import re
+        import subprocess
+        try:
+            output = subprocess.check_output([executable, '--version']).decode(errors='replace')
+            match = re.search(r'version (\d+)\.(\d+)(?:\.(\d+))?', output)
+            _cmake_versions[executable] = tuple(int(n or 0) for n in match.groups()) if match else (0, 0, 0)
+        except (OSError, subprocess.CalledProcessError):
+            _cmake_versions[executable] = (0, 0, 0)
+    return _cmake_versions[executable]
+
 
 def dump_option(key, value):
     if isinstance(value, bool):
@@ -56,20 +103,97 @@ def mkdir(path):
         if not os.path.exists(path):
             raise e
 
-def write_if_different(filepath, content, bufsize=256 * 256):
-    newdigest = hashlib.md5(content.encode()).digest()
-    md5 = hashlib.md5()
+def _encode(chunk):
+    return chunk.encode() if isinstance(chunk, str) else chunk
+
+
+# read once at import time, os.umask() can only be read by setting it, which races with other threads
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def _atomic_writer(filepath):
+    """Returns an open temporary file next to ``filepath`` meant to replace it with os.replace"""
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)),
+                               prefix='.%s.' % os.path.basename(filepath))
     try:
-        with open(filepath, 'rb') as f:
-            while True:
-                buffer = f.read(bufsize)
-                md5.update(buffer)
-                if len(buffer) < bufsize:
-                    break
+        mode = os.stat(filepath).st_mode & 0o7777
     except FileNotFoundError:
-        pass
-    if md5.digest() != newdigest:
-        open(filepath, 'w').write(content)
+        mode = 0o666 & ~_umask
+    os.chmod(tmp, mode)
+    return os.fdopen(fd, 'wb'), tmp
+
+
+def _write_atomic(filepath, chunks):
+    f, tmp = _atomic_writer(filepath)
+    try:
+        with f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, filepath)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_if_different(filepath, content, bufsize=256 * 256):
+    """Writes ``content`` (str, bytes or an iterable of them) to ``filepath`` unless the file already has
+    exactly that content, so that its timestamp (and the dependent build steps) are left untouched.
+    The file is replaced atomically. Returns True if the file was written."""
+    if isinstance(content, (str, bytes, bytearray)):
+        data = memoryview(_encode(content))
+        try:
+            if os.stat(filepath).st_size == len(data):
+                with open(filepath, 'rb') as f:
+                    offset = 0
+                    while offset < len(data):
+                        buffer = f.read(bufsize)
+                        if not buffer or data[offset:offset + len(buffer)] != buffer:
+                            break
+                        offset += len(buffer)
+                    else:
+                        return False
+        except FileNotFoundError:
+            pass
+        _write_atomic(filepath, [data])
+        return True
+
+    # streamed content: the new file is written while it is compared with the old one
+    f, tmp = _atomic_writer(filepath)
+    try:
+        try:
+            old = open(filepath, 'rb')
+        except FileNotFoundError:
+            old = None
+        same = old is not None
+        with f:
+            for chunk in content:
+                chunk = _encode(chunk)
+                f.write(chunk)
+                if same and old.read(len(chunk)) != chunk:
+                    same = False
+        if same and old.read(1):
+            same = False
+        old is not None and old.close()
+        if same:
+            os.remove(tmp)
+        else:
+            os.replace(tmp, filepath)
+        return not same
+    except BaseException:
+        os.path.exists(tmp) and os.remove(tmp)
+        raise
+
+
+def write_files(files, workers=None):
+    """Calls write_if_different concurrently on ``files``, a dict (or an iterable of pairs) mapping paths to
+    contents, and returns the number of files that were actually written"""
+    from concurrent.futures import ThreadPoolExecutor
+    items = files.items() if isinstance(files, dict) else files
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as executor:
+        return sum(executor.map(lambda item: write_if_different(*item), items))
+
 
 def mkcd(path): mkdir(path) and pushd(path)
 
@@ -89,17 +213,13 @@ def touch(fname, times=None):
 
 
 def strip(filepath, ts_filepath=None):
-    if not ts_filepath:
-        ts_filepath = filepath + '.strip_timestamp'
-    touch(ts_filepath)
-    subprocess.check_output(['strip', '-s', filepath])
+    from .postprocess import process_file
+    return process_file(filepath, ['strip'], ts_filepath)
 
 
 def upx(filepath, ts_filepath=None):
-    if not ts_filepath:
-        ts_filepath = filepath + '.upx_timestamp'
-    touch(ts_filepath)
-    subprocess.check_output(['upx', '--best', filepath])
+    from .postprocess import process_file
+    return process_file(filepath, ['upx'], ts_filepath)
 
 
 def _init():
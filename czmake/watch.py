@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import select
+import signal
+import struct
+import subprocess
+import threading
+import time
+from os.path import join, basename, normpath
+
+from .build import build_command
+from .jobs import build_env
+from .utils import echo
+from . import codemodel
+from .codemodel import cmake_files
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+
+def ignored(name):
+    return name.startswith('.') or name.endswith(('~', '.swp', '.swx', '.tmp')) or name == '4913'
+
+
+class InotifyWatcher:
+    """Watches a directory tree with inotify (through ctypes, Linux only)"""
+
+    def __init__(self, root, excluded):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.excluded = {normpath(path) for path in excluded}
+        self.directories = {}
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not ignored(d) and normpath(join(dirpath, d)) not in self.excluded]
+            wd = self.libc.inotify_add_watch(self.fd, dirpath.encode(), watch_mask)
+            if wd >= 0:
+                self.directories[wd] = dirpath
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Returns the paths of the files changed since the last call, None if events were lost"""
+        data = os.read(self.fd, 1 << 16)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode(errors='replace')
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            directory = self.directories.get(wd, None)
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+            if directory is None or not name or ignored(name):
+                continue
+            path = join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and normpath(path) not in self.excluded:
+                    self.add_tree(path)
+            else:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback watcher comparing the modification times of the files in the tree"""
+
+    interval = 1.0
+
+    def __init__(self, root, excluded):
+        self.root = root
+        self.excluded = {normpath(path) for path in excluded}
+        self.mtimes = self.scan()
+
+    def scan(self):
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not ignored(d) and normpath(join(dirpath, d)) not in self.excluded]
+            for name in filenames:
+                if not ignored(name):
+                    path = join(dirpath, name)
+                    try:
+                        result[path] = os.stat(path).st_mtime_ns
+                    except FileNotFoundError:
+                        pass
+        return result
+
+    def fileno(self):
+        return None
+
+    def read(self):
+        mtimes = self.scan()
+        changed = {path for path in set(mtimes) | set(self.mtimes) if mtimes.get(path) != self.mtimes.get(path)}
+        self.mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+
+class Builder:
+    """Runs one build at a time, starting a new build cancels the one in progress"""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.env = build_env(cfg)
+        self.lock = threading.Lock()
+        self.process = None
+        self.generation = 0
+
+    def _cancel(self):
+        if self.process is not None and self.process.poll() is None:
+            echo('-- Cancelling the running build')
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait()
+
+    def cancel(self):
+        with self.lock:
+            self._cancel()
+
+    def build(self, targets):
+        """Builds ``targets`` (all the default ones if empty), returns a dict describing the result"""
+        cmd = build_command(self.cfg, targets)
+        with self.lock:
+            # two builds never run at the same time in the build directory
+            self._cancel()
+            self.generation += 1
+            generation = self.generation
+            echo(' '.join(cmd))
+            start = time.time()
+            self.process = process = subprocess.Popen(cmd, env=self.env, start_new_session=True)
+        returncode = process.wait()
+        result = {'targets': list(targets), 'returncode': returncode, 'seconds': time.time() - start,
+                  'cancelled': generation != self.generation}
+        if not result['cancelled']:
+            echo('-- Build %s in %.2f s' % ('succeeded' if returncode == 0 else 'failed', result['seconds']))
+        return result
+
+
+def affected_targets(cfg, model, changed):
+    """Returns the targets to build for the ``changed`` files, None when the default targets must be built"""
+    if model is None:
+        return None
+    targets = set()
+    for path in changed:
+        if basename(path).endswith(cmake_files):
+            return None
+        owners = model.owners(path)
+        if not owners:
+            # headers and other files that are not listed as a target source
+            return None
+        targets.update(owners)
+    if cfg.get('cmake_target', None):
+        # only build what was asked for when configuring, plus the targets in between
+        wanted = set(cfg['cmake_target'])
+        targets = {target for target in model.dependents(targets) if target in wanted} or targets
+    return sorted(targets)
+
+
+def serve(builder, path):
+    """Accepts build requests as JSON lines on the unix socket ``path``, e.g. {"targets": ["foo"]},
+    and answers each one with the JSON result of the build"""
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode() or '{}')
+                    result = builder.build(request.get('targets', None) or builder.cfg.get('cmake_target', None) or [])
+                except ValueError as err:
+                    result = {'error': str(err)}
+                self.wfile.write((json.dumps(result) + '\n').encode())
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    echo('-- Listening for build requests on %s' % path)
+    return server
+
+
+def wait_for_changes(watcher, debounce):
+    """Blocks until some files change and then until no more changes arrive for ``debounce`` seconds,
+    returns the changed paths or None if some events were lost"""
+    changed = set()
+    deadline = None
+    while deadline is None or time.time() < deadline:
+        wait = None if deadline is None else max(0, deadline - time.time())
+        if watcher.fileno() is not None:
+            if not select.select([watcher], [], [], wait)[0]:
+                continue
+        else:
+            time.sleep(watcher.interval if wait is None else min(wait, watcher.interval))
+        events = watcher.read()
+        if events is None:
+            return None
+        if events:
+            changed |= events
+            deadline = time.time() + debounce
+    return changed
+
+
+def watch(cfg, debounce=0.3, socket_path=None):
+    source_directory = cfg['source_directory']
+    build_directory = cfg['build_directory']
+    excluded = [build_directory, join(source_directory, '.git')]
+    try:
+        watcher = InotifyWatcher(source_directory, excluded)
+    except (OSError, AttributeError) as err:
+        logger.warning('inotify is not available (%s), polling the source tree instead' % err)
+        watcher = PollingWatcher(source_directory, excluded)
+    model = codemodel.load(build_directory)
+    if model is None:
+        logger.warning('No CMake codemodel in "%s", every change will rebuild the default targets '
+                       '(run czconfigure again with CMake >= 3.14 to get one)' % build_directory)
+    builder = Builder(cfg)
+    server = serve(builder, socket_path) if socket_path else None
+    echo('-- Watching %s' % source_directory)
+    reload_model = False
+    try:
+        while True:
+            changed = wait_for_changes(watcher, debounce)
+            if reload_model:
+                # the previous build regenerated the build system
+                model = codemodel.load(build_directory)
+            reload_model = changed is None or any(basename(path).endswith(cmake_files) for path in changed)
+            targets = None if changed is None else affected_targets(cfg, model, changed)
+            if targets is None:
+                targets = cfg.get('cmake_target', None) or []
+            threading.Thread(target=builder.build, args=(targets,), daemon=True).start()
+    except KeyboardInterrupt:
+        builder.cancel()
+    finally:
+        watcher.close()
+        if server is not None:
+            server.shutdown()
+            os.remove(socket_path)